@@ -14,7 +14,7 @@ from multiprocessing import Pool
 
 from modules.aig import AIG
 from modules.algorithms import Base, GreedyAll, GreedyBB, GreedyFirst, TopW, L1S
-from modules.database import Database
+from modules.database import Database, data_version
 from modules.excludes import find_excludes
 from modules.logger import Logger
 from modules.mailer import Mailer
@@ -85,21 +85,21 @@ def set_weights(Q, tqid, tq_rank):
     for i, cqid in enumerate(cqids):
         Q[cqid].set_w(len(Q) - i)
 
-def run_task(mode, db, parser, qid, task, info, aig, tq_rank):
+def run_task(mode, db, parser, qid, task, info, aig, tq_rank, clique_opts=None):
     print("QUERY {}: {}".format(qid, mode))
 
     algorithm = None
 
     if mode == 'topw':
-        algorithm = TopW(db)
+        algorithm = TopW(db, aig=aig)
     elif mode == 'greedyall':
-        algorithm = GreedyAll(db)
+        algorithm = GreedyAll(db, aig=aig)
     elif mode == 'greedybb':
-        algorithm = GreedyBB(db, info=info, aig=aig)
+        algorithm = GreedyBB(db, info=info, aig=aig, **(clique_opts or {}))
     elif mode == 'greedyfirst':
-        algorithm = GreedyFirst(db, info=info, aig=aig)
+        algorithm = GreedyFirst(db, info=info, aig=aig, **(clique_opts or {}))
     elif mode == 'l1s':
-        algorithm = L1S(db)
+        algorithm = L1S(db, aig=aig)
 
     Q = parser.parse_many(qid, task['cqs'].copy())
 
@@ -113,6 +113,9 @@ def run_task(mode, db, parser, qid, task, info, aig, tq_rank):
         iters += 1
 
         print(meta)
+        print('Probe cache: {}'.format(db.probe_cache))
+        if db.result_cache is not None:
+            print('Result cache: {}'.format(db.result_cache))
         result_metas.append(meta)
 
         if not tuple:
@@ -121,6 +124,9 @@ def run_task(mode, db, parser, qid, task, info, aig, tq_rank):
 
         Q = user_feedback(Q, tuple_cqids, task['ans'])
 
+    db.probe_cache.save()
+    db.save_costs()
+
     if iters is None or len(Q) == 0:
         # if couldn't find tuple or no cand cqs left
         iters = None
@@ -140,17 +146,44 @@ def run_task(mode, db, parser, qid, task, info, aig, tq_rank):
     }
     return result
 
-def start_thread(mode, db_name, qid, task, info, tq_rank, log_dir=None):
+def start_thread(mode, db_name, qid, task, info, tq_rank, log_dir=None, version=None):
     config = ConfigParser.RawConfigParser(allow_no_value=True)
     config.read('config.ini')
 
-    db = Database(config.get('database', 'user'), config.get('database', 'pw'), config.get('database', 'host'), db_name, config.get('database', 'cache_dir'), timeout=config.get('database', 'timeout'), buffer_pool_size=config.get('database', 'buffer_pool_size'))
+    pool_size = None
+    if config.has_option('database', 'pool_size'):
+        pool_size = config.get('database', 'pool_size')
+    persist_probes = False
+    if config.has_option('database', 'persist_probes'):
+        persist_probes = config.getboolean('database', 'persist_probes')
+    keep_partial = False
+    if config.has_option('database', 'keep_partial'):
+        keep_partial = config.getboolean('database', 'keep_partial')
+    result_cache_dir = None
+    if config.has_option('database', 'result_cache_dir'):
+        result_cache_dir = config.get('database', 'result_cache_dir')
+
+    # clique search in greedybb and greedyfirst: processes, and budgets after which
+    # remaining CQs are covered greedily (0 = no budget)
+    clique_opts = {}
+    if config.has_option('algorithm', 'clique_processes'):
+        clique_opts['clique_processes'] = config.getint('algorithm', 'clique_processes')
+    if config.has_option('algorithm', 'clique_time_budget') and config.getfloat('algorithm', 'clique_time_budget') > 0:
+        clique_opts['clique_time_budget'] = config.getfloat('algorithm', 'clique_time_budget')
+    if config.has_option('algorithm', 'max_cliques') and config.getint('algorithm', 'max_cliques') > 0:
+        clique_opts['max_cliques'] = config.getint('algorithm', 'max_cliques')
+
+    db = Database(config.get('database', 'user'), config.get('database', 'pw'), config.get('database', 'host'), db_name, config.get('database', 'cache_dir'), timeout=config.get('database', 'timeout'), buffer_pool_size=config.get('database', 'buffer_pool_size'), pool_size=pool_size, persist_probes=persist_probes, keep_partial=keep_partial, result_cache_dir=result_cache_dir, data_version=version)
     parser = SQLParser(db_name, config.get('parser', 'cache_dir'))
 
     # only load aig if info includes range
     aig = None
+    aig_path = os.path.join(config.get('aig', 'dir'), db_name + '.aig')
     if (mode == 'greedybb' or mode == 'greedyfirst') and info == 'range':
-        aig = AIG(db, os.path.join(config.get('aig', 'dir'), db_name + '.aig'))
+        aig = AIG(db, aig_path)
+    elif info == 'range' and os.path.exists(aig_path):
+        # other modes only use an existing aig to rule out membership probes
+        aig = AIG(db, aig_path)
 
     data = json.loads(task)
     task_cleaned = {
@@ -167,9 +200,9 @@ def start_thread(mode, db_name, qid, task, info, tq_rank, log_dir=None):
         log_path = os.path.join(log_dir, str(qid) + '.log')
 
         with Logger(log_path):
-            return run_task(mode, db, parser, qid, task, info, aig, tq_rank)
+            return run_task(mode, db, parser, qid, task, info, aig, tq_rank, clique_opts=clique_opts)
     else:
-        return run_task(mode, db, parser, qid, task, info, aig, tq_rank)
+        return run_task(mode, db, parser, qid, task, info, aig, tq_rank, clique_opts=clique_opts)
 
 def load_tasks(data_dir, db_name):
     with open(os.path.join(data_dir, db_name + '.json')) as f:
@@ -239,13 +272,18 @@ def main():
     # load qids to exclude
     excludes = find_excludes(args.db)
 
+    # version of the data for the result cache, computed once as it scans every table
+    version = None
+    if config.has_option('database', 'result_cache_dir') and config.get('database', 'result_cache_dir'):
+        version = data_version(config.get('database', 'user'), config.get('database', 'pw'), config.get('database', 'host'), args.db)
+
     try:
         if args.qid is not None:
             # if executing single query
             if args.qid in results:
                 print('QUERY {}: Skipping, already in cache.'.format(args.qid))
             else:
-                results[args.qid] = start_thread(args.mode, args.db, args.qid, json.dumps(tasks[args.qid]), args.info, args.tq_rank)
+                results[args.qid] = start_thread(args.mode, args.db, args.qid, json.dumps(tasks[args.qid]), args.info, args.tq_rank, version=version)
                 # save_cache(results, cache_path)
             # print_result(args.qid, results[args.qid])
         else:
@@ -262,7 +300,7 @@ def main():
                 if qid in results:
                     print('QUERY {}: Skipping, already in cache.'.format(qid))
                 else:
-                    responses[qid] = pool.apply_async(start_thread, (args.mode, args.db, qid, json.dumps(task), args.info, args.tq_rank, log_dir))
+                    responses[qid] = pool.apply_async(start_thread, (args.mode, args.db, qid, json.dumps(task), args.info, args.tq_rank, log_dir, version))
 
             responses = OrderedDict(sorted(responses.items(), key=lambda r: r[0]))
             for qid, res in responses.items():
@@ -2,6 +2,8 @@ import os
 import pickle
 import time
 
+from .database import AllAttributeIntersect
+
 # Attribute Intersection Graph
 class AIG(object):
     def __init__(self, db, path):
@@ -66,6 +68,24 @@ class AIG(object):
         frm.add_neighbor(to, e)
         to.add_neighbor(frm, e)
 
+    # AttributeIntersect for each position of two attribute lists, or None if
+    # the attributes at some position share no values
+    def get_intersects(self, attrs1, attrs2):
+        if len(attrs1) != len(attrs2):
+            return None
+
+        intersects = []
+        for attr1, attr2 in zip(attrs1, attrs2):
+            if attr1 == attr2 or attr1 not in self.vertices or attr2 not in self.vertices:
+                intersects.append(AllAttributeIntersect(attr1.type))
+                continue
+
+            e = self.vertices[attr1].get_edge(attr2)
+            if e is None:
+                return None
+            intersects.append(e.intersect)
+        return intersects
+
     def get_attrs(self):
         return self.vertices.keys()
 
@@ -1,20 +1,255 @@
 from __future__ import division, print_function
 
+import bisect
+import heapq
+import math
 import random
+import threading
 import time
 import traceback
 
 from collections import OrderedDict
-from itertools import combinations
-from Queue import PriorityQueue
+from multiprocessing.pool import ThreadPool
 
 import numpy as np
 
-from .query import Query
+from .membership import CQBitmask, MembershipMatrix, iter_bits
+from .query import Query, PROBE_BATCH_SIZE, PROBE_UNION_SIZE
 from .qig import QIGByType, QIGByRange
 
 TOP_TUPLES = 5
-BOUND_LIMIT = 15
+# max CQs for computing entropies with a sum over all subsets of CQs
+ENTROPY_SOS_MAX_CQS = 20
+# max cells of the signature subset matrix compared at once
+ENTROPY_CHUNK_CELLS = 1 << 24
+# max subset tests between changed and kept signatures for updating entropy terms
+# by delta, beyond which the terms of all signatures are recomputed at once
+ENTROPY_DELTA_MAX_PAIRS = 1 << 18
+
+# points not dominated by another point in both coordinates, in descending
+# order, and the largest first coordinate m (0 if there are no points)
+def skyline(points):
+    result = []
+    best = None
+    for p in sorted(set(points), reverse=True):
+        # every point before p has a first coordinate at least as large
+        if best is None or p[1] > best:
+            result.append(p)
+            best = p[1]
+
+    m = result[0][0] if result else 0
+    return result, m
+
+# for distinct signatures a, the rows of matrix, with counts c: above(a) is the sum
+# of c(b) over strict supersets b of a, and below(a) the number of strict subsets
+# of a. L1S takes u_plus(a) = 1 + above(a) and u_minus(a) = 1 + c(a) below(a)
+def entropy_terms(matrix, counts):
+    k = len(matrix)
+    m = len(matrix.cqids)
+
+    if m <= ENTROPY_SOS_MAX_CQS and (1 << m) <= k * k:
+        # sum over subsets, indexed by CQ bitmask
+        masks = matrix.masks()
+        above = np.zeros(1 << m, dtype=np.int64)
+        above[masks] = counts
+        below = np.zeros(1 << m, dtype=np.int64)
+        below[masks] = 1
+        for i in range(m):
+            view = above.reshape(-1, 2, 1 << i)
+            view[:, 0, :] += view[:, 1, :]
+            view = below.reshape(-1, 2, 1 << i)
+            view[:, 1, :] += view[:, 0, :]
+        return above[masks] - counts, below[masks] - 1
+
+    # pairwise subset tests on packed bits, a chunk of signatures at a time
+    bits = matrix.bits
+    above = np.zeros(k, dtype=np.int64)
+    below = np.zeros(k, dtype=np.int64)
+    chunk = max(1, ENTROPY_CHUNK_CELLS // max(1, k * bits.shape[1]))
+    for start in range(0, k, chunk):
+        rows = bits[start:start + chunk]
+        is_subset = ((rows[:, None, :] & ~bits[None, :, :]) == 0).all(axis=2)
+        diag = np.arange(len(rows))
+        is_subset[diag, start + diag] = False
+        above[start:start + chunk] += is_subset.dot(counts)
+        below += is_subset.sum(axis=0)
+    return above, below
+
+# tuples probed per call of min_objective_tuple that turn out not to be in all
+# CQs. probing can raise an objective above that of an unprobed tuple, so more
+# probes can find a better tuple, at the cost of one more round trip each
+MIN_OBJECTIVE_MAX_PROBES = 1
+
+# tuples of the state grouped by signature, the frozenset of CQs a tuple is known
+# to belong to. the weight w(S) of each signature is kept with the distinct weights
+# in sorted order, so signatures by objective |w(S) - w(Q - S)| = |2 w(S) - w(Q)|
+# are found around w(Q) / 2 without recomputing any objective as Q shrinks
+class SignatureIndex(object):
+    def __init__(self):
+        self.members = {}          # signature -> set of tuples
+        self.filed = {}            # tuple -> its signature
+        self.weights = {}          # signature -> w(S)
+        self.by_weight = {}        # w(S) -> signatures with that weight
+        self.sorted_weights = []   # distinct weights of the signatures, ascending
+        self.cq_weights = {}       # cqid -> weight, fixed during a task
+
+    def __len__(self):
+        return len(self.members)
+
+    def __contains__(self, t):
+        return t in self.filed
+
+    def signature(self, t):
+        return self.filed[t]
+
+    def objective(self, S, total_w):
+        return abs(2 * self.weights[S] - total_w)
+
+    # called with each signature whose tuples changed
+    def touch(self, S):
+        pass
+
+    def add_signature(self, S, ts):
+        w = sum(self.cq_weights[cqid] for cqid in S)
+        self.members[S] = ts
+        self.weights[S] = w
+        if w not in self.by_weight:
+            self.by_weight[w] = set()
+            bisect.insort(self.sorted_weights, w)
+        self.by_weight[w].add(S)
+        self.touch(S)
+
+    def remove_signature(self, S):
+        ts = self.members.pop(S)
+        w = self.weights.pop(S)
+        sigs = self.by_weight[w]
+        sigs.discard(S)
+        if not sigs:
+            del self.by_weight[w]
+            del self.sorted_weights[bisect.bisect_left(self.sorted_weights, w)]
+        self.touch(S)
+        return ts
+
+    # files t under the signature of the CQs S, moving it from its old one
+    def file(self, t, S):
+        S = frozenset(S)
+        old = self.filed.get(t)
+        if old == S:
+            return
+        if old is not None:
+            self.remove(t)
+        if S in self.members:
+            self.members[S].add(t)
+            self.touch(S)
+        else:
+            self.add_signature(S, set([t]))
+        self.filed[t] = S
+
+    def remove(self, t):
+        S = self.filed.pop(t, None)
+        if S is None:
+            return
+        ts = self.members[S]
+        ts.discard(t)
+        if ts:
+            self.touch(S)
+        else:
+            self.remove_signature(S)
+
+    # moves all tuples of S to S_new, merging them with any tuples already there
+    def move(self, S, S_new):
+        ts = self.remove_signature(S)
+        if S_new in self.members:
+            self.members[S_new] |= ts
+            self.touch(S_new)
+        else:
+            self.add_signature(S_new, ts)
+        for t in ts:
+            self.filed[t] = S_new
+
+    # removes S and its tuples, which are returned
+    def drop(self, S):
+        ts = self.remove_signature(S)
+        for t in ts:
+            del self.filed[t]
+        return ts
+
+    # (objective, signature) pairs in ascending objective order, walking out from
+    # the weights closest to total_w / 2. signatures added while iterating are not
+    # visited
+    def by_objective(self, total_w):
+        weights = list(self.sorted_weights)
+        hi = bisect.bisect_left(weights, total_w / 2)
+        lo = hi - 1
+        while lo >= 0 or hi < len(weights):
+            if hi == len(weights) or (lo >= 0 and total_w - 2 * weights[lo] <= 2 * weights[hi] - total_w):
+                w = weights[lo]
+                lo -= 1
+            else:
+                w = weights[hi]
+                hi += 1
+            for S in list(self.by_weight.get(w, ())):
+                if S in self.members:
+                    yield abs(2 * w - total_w), S
+
+# signature index that also keeps the L1S entropy terms of each signature, see
+# entropy_terms. the signatures touched since the last update change the terms of
+# the others by delta, and only their own are computed in full
+class EntropyIndex(SignatureIndex):
+    def __init__(self):
+        super(EntropyIndex, self).__init__()
+        self.touched = set()   # signatures touched since the last update
+        self.counts = {}       # signature -> number of tuples at the last update
+        self.above = {}        # signature -> tuples in strict supersets
+        self.below = {}        # signature -> number of strict subsets
+
+    def touch(self, S):
+        self.touched.add(S)
+
+    def update_entropies(self, Q):
+        changed = [S for S in self.touched if len(self.members.get(S, ())) != self.counts.get(S, 0)]
+        self.touched = set()
+        if len(changed) * len(self.members) > ENTROPY_DELTA_MAX_PAIRS:
+            self.rebuild_entropies(Q)
+            return
+
+        # changes of each signature against the terms of those kept before
+        for b in changed:
+            delta = len(self.members.get(b, ())) - self.counts.get(b, 0)
+            appeared = (b in self.members) - (b in self.counts)
+            for a in self.above:
+                if b < a:
+                    self.below[a] += appeared
+                elif a < b:
+                    self.above[a] += delta
+
+        for b in changed:
+            if b not in self.members:
+                del self.counts[b]
+                del self.above[b]
+                del self.below[b]
+                continue
+            self.counts[b] = len(self.members[b])
+            if b not in self.above:
+                # new since the last update, against all signatures
+                above = 0
+                below = 0
+                for a, ts in self.members.iteritems():
+                    if b < a:
+                        above += len(ts)
+                    elif a < b:
+                        below += 1
+                self.above[b] = above
+                self.below[b] = below
+
+    def rebuild_entropies(self, Q):
+        matrix = MembershipMatrix(Q, dict((S, S) for S in self.members))
+        sigs = matrix.tuples
+        counts = np.array([len(self.members[S]) for S in sigs], dtype=np.int64)
+        above, below = entropy_terms(matrix, counts)
+        self.counts = dict(zip(sigs, counts.tolist()))
+        self.above = dict(zip(sigs, above.tolist()))
+        self.below = dict(zip(sigs, below.tolist()))
 
 class Base(object):
     def __init__(self, db, aig=None, info=None):
@@ -22,6 +257,18 @@ class Base(object):
         self.aig = aig
         self.info = info
 
+        # (src cqid, dst cqid) -> AttributeIntersects by position, from the AIG
+        self.intersects = {}
+
+        # tuple -> cqids, kept across the feedback iterations of a task
+        self.tuples = None
+        # cqids of Q when self.tuples was last updated
+        self.state_cqids = set()
+        # cqid -> CQ whose executed tuples are already in self.tuples
+        self.merged = {}
+        # tuples of self.tuples by signature, without those in all CQs
+        self.signatures = SignatureIndex()
+
     def execute(self, cqs):
         result_meta = {
             'objective': 0,
@@ -41,16 +288,9 @@ class Base(object):
         by_cost.sort(key=lambda x: x[1])
         return by_cost
 
-    def run_cqs(self, cqs, msg_append='', qig=None, tuples=None):
-        if tuples is None:
-            tuples = {}
-        valid_cqs = []
-        timed_out = []
-        sql_errors = []
-        cached = []
+    def execute_by_cost(self, cqs):
+        # yields (cqid, cq_tuples, was_cached, error) for each CQ in ascending cost order
         timeout_encountered = False
-
-        start = time.time()
         for cqid, cost in self.sort_by_cost(cqs):
             cq = cqs[cqid]
 
@@ -60,38 +300,135 @@ class Base(object):
 
             try:
                 cq_tuples, was_cached = self.db.execute(cq)
-                if was_cached:
-                    cached.append(cqid)
+            except Exception:
+                print(traceback.format_exc())
+                yield cqid, None, False, True
+                continue
 
-                if cq.timed_out:
-                    timeout_encountered = True
-                    timed_out.append(cqid)
-                elif cq.tuples:
-                    valid_cqs.append(cqid)
+            if cq.timed_out:
+                timeout_encountered = True
 
-                if cq.tuples:
-                    for t in cq_tuples:
-                        if t not in tuples:
-                            tuples[t] = set()
-                        tuples[t].add(cqid)
+            yield cqid, cq_tuples, was_cached, False
+
+    def execute_by_cost_parallel(self, cqs):
+        # same as execute_by_cost, but CQs are submitted in ascending cost order
+        # to the connection pool and yielded in the same order
+        lock = threading.Lock()
+        timeout_cost = [None]
+
+        def execute_one(item):
+            cqid, cost = item
+            cq = cqs[cqid]
+
+            with lock:
+                if timeout_cost[0] is not None and cost >= timeout_cost[0]:
+                    # all CQs with higher cost are automatically assumed timed out
+                    cq.timed_out = True
+
+            try:
+                with self.db.pool.connection() as conn:
+                    cq_tuples, was_cached = self.db.execute(cq, conn=conn)
             except Exception:
                 print(traceback.format_exc())
+                return cqid, None, False, True
+
+            if cq.timed_out:
+                with lock:
+                    if timeout_cost[0] is None or cost < timeout_cost[0]:
+                        timeout_cost[0] = cost
+
+            return cqid, cq_tuples, was_cached, False
+
+        # equivalent CQs run in the same worker, so only the first hits the database
+        groups = OrderedDict()
+        for item in self.sort_by_cost(cqs):
+            groups.setdefault(cqs[item[0]].get_fingerprint(), []).append(item)
+
+        def execute_group(group):
+            return [execute_one(item) for item in group]
+
+        workers = ThreadPool(self.db.pool.size)
+        try:
+            for results in workers.imap(execute_group, groups.values()):
+                for result in results:
+                    yield result
+        finally:
+            workers.close()
+            workers.join()
+
+    # merged is a dict of the CQs whose tuples are already in tuples, which are
+    # skipped when merging and updated with newly merged CQs
+    def run_cqs(self, cqs, msg_append='', qig=None, tuples=None, merged=None):
+        if tuples is None:
+            tuples = {}
+        valid_cqs = []
+        timed_out = []
+        sql_errors = []
+        cached = []
+        partial = []
+
+        if self.db.pool is not None:
+            results = self.execute_by_cost_parallel(cqs)
+        else:
+            results = self.execute_by_cost(cqs)
+
+        # tuples of the kept state whose CQs changed, refiled after the run
+        changed = set() if tuples is self.tuples else None
+
+        start = time.time()
+        for cqid, cq_tuples, was_cached, error in results:
+            cq = cqs[cqid]
+
+            if error:
                 sql_errors.append(cqid)
+                continue
+
+            if was_cached:
+                cached.append(cqid)
+
+            if cq.timed_out:
+                timed_out.append(cqid)
+                if getattr(cq, 'partial', False):
+                    partial.append(cqid)
+            elif cq.tuples:
+                valid_cqs.append(cqid)
+
+            if merged is not None and merged.get(cqid) is cq:
+                continue
+
+            if cq.tuples:
+                for t in cq_tuples:
+                    if t not in tuples:
+                        tuples[t] = set()
+                    tuples[t].add(cqid)
+                if merged is not None:
+                    merged[cqid] = cq
+                if changed is not None:
+                    changed.update(cq_tuples)
+
+        if changed:
+            self.refile(changed)
 
         query_time = time.time() - start
         print("Done executing CQs [{}s]".format(query_time))
 
         self.print_stats(cqs.keys(), timed_out, sql_errors, valid_cqs, cached)
+        print('Partial Timed Out CQs ({}): {}'.format(len(partial), partial))
 
         return tuples, valid_cqs, timed_out, sql_errors, query_time
 
-    def incremental_exec(self, Q, tuples, timed_out):
+    # timed out CQs whose stream fails with an error are moved to sql_errors
+    def incremental_exec(self, Q, tuples, timed_out, sql_errors=None):
         print('Running incremental execution for timed out queries...')
         start = time.time()
 
         # sort timed out cqs by descending weight
         by_weight = sorted(filter(lambda x: x[0] in timed_out, Q.iteritems()), key=lambda x: -x[1].w)
 
+        # streams that timed out in an earlier round get another try
+        for cqid, cq in by_weight:
+            cq.get_incremental().retry()
+
         # incremental execution of each CQ
         while True:
             no_tuple_count = 0
@@ -101,6 +438,10 @@ class Base(object):
                 t = self.db.execute_incremental(cq)
 
                 if not t:
+                    incr = cq.get_incremental()
+                    if incr.error is not None and sql_errors is not None and cqid not in sql_errors:
+                        sql_errors.append(cqid)
+                        timed_out.remove(cqid)
                     print('No tuple found.')
                     no_tuple_count += 1
                     continue
@@ -109,19 +450,22 @@ class Base(object):
                     tuples[t] = set()
                 tuples[t].add(cqid)
 
-                for other_cqid in (set(timed_out) - set([cqid])):
-                    print('Checking if it belongs to {}...'.format(other_cqid))
-                    if Query.tuple_in_query(self.db, t, Q[other_cqid]):
-                        tuples[t].add(other_cqid)
+                check_cqids = self.probe_candidates(Q, t, tuples[t], timed_out)
+                print('Checking if it belongs to {} other timed out CQs...'.format(len(check_cqids)))
+                tuples[t] |= Query.queries_containing_tuple(self.db, t, [Q[c] for c in check_cqids])
 
                 if tuples[t] != set(Q.iterkeys()):
                     print('Found incremental tuple.')
                     found = True
-                    break
                 else:
                     print('Belongs to all CQs, skip.')
                     del tuples[t]
-                    cq.empty_cache()
+                    cq.get_incremental().consume()
+
+                if tuples is self.tuples:
+                    self.refile([t])
+                if found:
+                    break
 
             if no_tuple_count == len(by_weight):
                 break
@@ -144,75 +488,208 @@ class Base(object):
                 diff_w += cq.w
         return abs(S_w - diff_w)
 
-    def calc_objectives(self, Q, T):
-        print("Calculating objective values...")
-        start = time.time()
-
-        objectives = {}
-        memo = {}
-        for t, S in T.iteritems():
-            S_key = frozenset(S)
-            if S_key in memo:
-                objectives[t] = memo[S_key]
-            else:
-                objectives[t] = self.objective(Q, S)
-                memo[S_key] = objectives[t]
-
-        objective_time = time.time() - start
-        print("Done calculating objectives [{}s]".format(objective_time))
-        return objectives, objective_time
-
-    def min_objective_tuples(self, Q, T, objectives, check_Q):
-        # operates on "minimal intervention policy"
+    # uses the AIG to check whether the values t, known to belong to src_cqid,
+    # could also belong to dst_cqid without probing the database
+    def may_contain(self, Q, t, src_cqid, dst_cqid):
+        if self.aig is None:
+            return True
+
+        key = (src_cqid, dst_cqid)
+        if key not in self.intersects:
+            src_attrs = Q[src_cqid].get_probe(self.db).attrs
+            dst_attrs = Q[dst_cqid].get_probe(self.db).attrs
+            self.intersects[key] = self.aig.get_intersects(src_attrs, dst_attrs)
+
+        intersects = self.intersects[key]
+        if intersects is None or not all(i.contains(v) for i, v in zip(intersects, t)):
+            self.db.probe_cache.skipped += 1
+            return False
+        return True
+
+    # CQs in check_Q that t could belong to, given it belongs to the CQs in S
+    def probe_candidates(self, Q, t, S, check_Q):
+        if not S:
+            return [cqid for cqid in check_Q]
+        if self.aig is None:
+            return [cqid for cqid in check_Q if cqid not in S]
+        src_cqid = next(iter(S))
+        vals = self.db.codec.decode(t)
+        return [cqid for cqid in check_Q if cqid not in S and self.may_contain(Q, vals, src_cqid, cqid)]
+
+    # adds each CQ in check_Q to T[t] for the tuples t in ts that belong to it,
+    # probing either one tuple or one CQ at a time, whichever needs fewer round trips
+    def probe_tuples(self, Q, T, ts, check_Q):
+        if not ts or not check_Q:
+            return
+
+        per_tuple_trips = len(ts) * int(math.ceil(len(check_Q) / PROBE_UNION_SIZE))
+        per_cq_trips = len(check_Q) * int(math.ceil(len(ts) / PROBE_BATCH_SIZE))
+
+        candidates = {}
+        for t in ts:
+            candidates[t] = self.probe_candidates(Q, t, T[t], check_Q)
+
+        if per_tuple_trips <= per_cq_trips:
+            for t in ts:
+                T[t] |= Query.queries_containing_tuple(self.db, t, [Q[cqid] for cqid in candidates[t]])
+        else:
+            by_cqid = {}
+            for t in ts:
+                for cqid in candidates[t]:
+                    by_cqid.setdefault(cqid, []).append(t)
+            for cqid, cq_ts in by_cqid.items():
+                for t in Query.tuples_in_query(self.db, cq_ts, Q[cqid]):
+                    T[t].add(cqid)
+
+        if T is self.tuples:
+            self.refile(ts)
+
+    # checks tuples ts in order against the CQs in check_Q, in batches that double
+    # in size, until one is found that does not belong to all CQs in Q.
+    # returns that tuple (or None), the tuples found to belong to all CQs,
+    # and every tuple that was checked.
+    def first_informative_tuple(self, Q, T, ts, check_Q):
+        Q_keys = set(Q.iterkeys())
+        in_all = []
+        probed = []
+
+        start = 0
+        batch_size = 1
+        while start < len(ts):
+            batch = ts[start:start + batch_size]
+            start += batch_size
+            batch_size *= 2
+
+            self.probe_tuples(Q, T, batch, check_Q)
+            probed.extend(batch)
+
+            for t in batch:
+                # tuples of the kept state in all CQs were already dropped from it
+                if t not in T or T[t] == Q_keys:
+                    in_all.append(t)
+                else:
+                    return t, in_all, probed
+        return None, in_all, probed
+
+    # returns the tuple to show, its objective and the time taken. the tuple has the
+    # min objective among signatures for which accept holds, and is checked against
+    # the CQs in check_Q. tuples that turn out to be in all CQs are dropped
+    def min_objective_tuple(self, Q, check_Q, accept=None):
+        # operates on "minimal intervention policy": the best tuples are probed one
+        # at a time, stopping after MIN_OBJECTIVE_MAX_PROBES that are not in all CQs
+        # or once no unprobed signature can beat the best tuple
         print('Finding min objective tuples, including timed out queries...')
         start = time.time()
 
-        objectives = OrderedDict(sorted(objectives.iteritems(), key=lambda t: t[1]))
-        to_delete = []
-        for t, objective in objectives.iteritems():
-            S = T[t]
+        total_w = sum(cq.w for cq in Q.itervalues())
+        best = None
+        best_objective = None
+        probes = 0
+        for objective, S in self.signatures.by_objective(total_w):
+            if probes >= MIN_OBJECTIVE_MAX_PROBES or (best is not None and best_objective <= objective):
+                break
+            if accept is not None and not accept(S):
+                continue
+            if not check_Q:
+                best = next(iter(self.signatures.members[S]))
+                best_objective = objective
+                break
 
-            # check if t exists in any queries not yet executed/timed out
-            for cqid in check_Q:
-                if Query.tuple_in_query(self.db, t, Q[cqid]):
-                    S.add(cqid)
+            for t in list(self.signatures.members.get(S, ())):
+                self.probe_tuples(Q, self.tuples, [t], check_Q)
+                if t not in self.signatures:
+                    # in all CQs, refiling dropped it
+                    continue
 
-            # recalculate objective for this
-            objectives[t] = self.objective(Q, S)
+                probes += 1
+                t_objective = self.signatures.objective(self.signatures.signature(t), total_w)
+                if best is None or t_objective < best_objective:
+                    best = t
+                    best_objective = t_objective
+                if probes >= MIN_OBJECTIVE_MAX_PROBES or best_objective <= objective:
+                    break
 
-            if S == set(Q.iterkeys()):
-                to_delete.append(t)
+        min_obj_time = time.time() - start
+        print('Done finding min objective tuples. [{}s]'.format(min_obj_time))
+        return best, best_objective, min_obj_time
+
+    # files the tuples ts under their current CQs in self.tuples. tuples in all CQs
+    # of the state tell none apart, and as feedback only removes CQs they never
+    # will, so they are dropped
+    def refile(self, ts):
+        for t in ts:
+            S = self.tuples.get(t)
+            if S is None:
+                self.signatures.remove(t)
+            elif S == self.state_cqids:
+                self.signatures.remove(t)
+                del self.tuples[t]
             else:
-                # only execute up to the first
-                break
+                self.signatures.file(t, S)
 
-        for t in to_delete:
-            del objectives[t]
-            del T[t]
+    # brings the tuple map kept across iterations up to date with Q, removing the
+    # CQs dropped by feedback from the signatures and tuples that contain them
+    def sync_state(self, Q):
+        start = time.time()
+        if self.tuples is None:
+            self.tuples = {}
 
-        min_obj_time = time.time() - start
-        print('Done finding min objective tuples. [{}s]'.format(min_obj_time))
-        return objectives, min_obj_time
+        dropped = self.state_cqids - set(Q.iterkeys())
+        self.state_cqids = set(Q.iterkeys())
+        for cqid in dropped:
+            self.merged.pop(cqid, None)
+        for cqid, cq in Q.iteritems():
+            self.signatures.cq_weights[cqid] = cq.w
+
+        # every tuple of the state is filed, so only signatures with dropped CQs
+        # change, and signatures equal to Q now no longer tell CQs apart
+        Q_keys = frozenset(self.state_cqids)
+        moved = 0
+        for S in [S for S in self.signatures.members if S & dropped or S == Q_keys]:
+            S_new = S - dropped
+            if not S_new or S_new == Q_keys:
+                for t in self.signatures.drop(S):
+                    del self.tuples[t]
+                continue
+            for t in self.signatures.members[S]:
+                self.tuples[t] -= dropped
+            moved += 1
+            self.signatures.move(S, S_new)
+
+        print('Updated {} signatures for {} dropped CQs [{}s]'.format(moved, len(dropped), time.time() - start))
+        return self.tuples
 
     def return_tuple(self, Q, t, cqids, result_meta):
-        # remove t from all CQ caches in Q before returning
+        # remove t from all CQ caches, incremental cursors in Q and the kept tuple map
+        # before returning
         for cqid, cq in Q.iteritems():
             if cq.tuples:
                 cq.tuples.discard(t)
+            cq.get_incremental().discard(t)
+        if self.tuples is not None and t in self.tuples:
+            del self.tuples[t]
+            self.signatures.remove(t)
 
-                if not cq.tuples:
-                    # if it's the only tuple, then empty cache so it runs again next time for incremental exec
-                    cq.empty_cache()
+        # callers get the values of t
+        if t is not None:
+            t = self.db.codec.decode(t)
 
         return t, cqids, result_meta
 
     def print_tuple(self, t, objective, S):
+        if t is not None:
+            t = self.db.codec.decode(t)
         print("{}, Objective: {}, # CQs: {}, CQs: {}".format(t, objective, len(S), S))
 
-    def print_best_tuples(self, Q, objectives, T, k):
+    def print_best_tuples(self, Q, k):
         print("Top {} tuples:".format(k))
-        for t, objective in objectives.items()[0:k]:
-            self.print_tuple(t, objective, T[t])
+        shown = 0
+        for objective, S in self.signatures.by_objective(sum(cq.w for cq in Q.itervalues())):
+            for t in self.signatures.members[S]:
+                if shown == k:
+                    return
+                self.print_tuple(t, objective, S)
+                shown += 1
 
     def print_stats(self, exec_cqs, timed_out, sql_errors, valid_cqs, cached):
         print('Executed CQs ({}): {}'.format(len(exec_cqs), exec_cqs))
@@ -222,134 +699,88 @@ class Base(object):
         print('Valid CQs ({}): {}'.format(len(valid_cqs), valid_cqs))
 
 class L1S(Base):
-    def informative_tuples(self, Q, T):
-        start = time.time()
-        print('Finding informative tuples...')
-        result = {}
-        inf_counts = {}
-        for t, S in T.iteritems():
-            S_key = frozenset(S)
-            if len(Q) != len(S):
-                if S_key not in inf_counts:
-                    result[t] = S
-                    inf_counts[S_key] = 1
-                else:
-                    inf_counts[S_key] += 1
+    def __init__(self, db, aig=None, info=None):
+        super(L1S, self).__init__(db, aig=aig, info=info)
 
-        inf_time = time.time() - start
-        print('Done finding {} informative tuples [{}s].'.format(len(result), inf_time))
-        return result, inf_counts, inf_time
+        # the signatures also keep their entropy terms as tuples move between them
+        self.signatures = EntropyIndex()
 
-    def find_entropies(self, T, inf_counts):
+    # the entropy of one tuple of each signature that is not all of Q, and these
+    # tuples by entropy
+    def find_entropies(self, Q):
         print('Finding entropies...')
         start = time.time()
 
-        is_subset = np.eye(len(T))
-        T_items = T.items()
-        for i, item in enumerate(T_items):
-            t, S = item
-            S_key = frozenset(S)
-            # is_subset[i,i] = 1
-            for j in range(i+1, len(T)):
-                t2, S2 = T_items[j]
-                S2_key = frozenset(S2)
-
-                if len(S) == len(S2):
-                    if S == S2:
-                        is_subset[i,j] = inf_counts[S2_key]
-                        is_subset[j,i] = inf_counts[S_key]
-                elif len(S) > len(S2):
-                    if S2 < S:
-                        is_subset[j,i] = inf_counts[S_key]
-                else:
-                    if S < S2:
-                        is_subset[i,j] = inf_counts[S2_key]
+        self.signatures.update_entropies(Q)
 
         entropies = {}
-        entropy_set = set()
-
-        u_plus_vals = np.sum(is_subset, axis=1)
-        u_minus_vals = np.sum(is_subset, axis=0)
-        for i, t in enumerate(T.iterkeys()):
-            u_plus = u_plus_vals[i]
-            u_minus = u_minus_vals[i]
-
+        by_entropy = {}
+        for S, ts in self.signatures.members.iteritems():
+            u_plus = 1 + self.signatures.above[S]
+            u_minus = 1 + len(ts) * self.signatures.below[S]
             entropy = (min(u_plus, u_minus), max(u_plus, u_minus))
+            t = next(iter(ts))
             entropies[t] = entropy
-            entropy_set.add(entropy)
+            by_entropy.setdefault(entropy, []).append(t)
 
         print('Done finding entropies [{}s].'.format(time.time() - start))
-        return entropies, entropy_set
+        return entropies, by_entropy
 
-    def find_best_entropy_tuple(self, Q, tuples, T, inf_counts, timed_out):
+    def find_best_entropy_tuple(self, Q, timed_out):
         print('Finding best entropy tuple...')
         start = time.time()
 
-        # calculate entropies for each tuple
-        entropies, entropy_set = self.find_entropies(T, inf_counts)
-
-        # 94s on iteration 1 for mondial Q5. TODO: beat it
-        # entropies, entropy_set = self.find_entropies_slow(T)
-
-        m = 0
-        skyline = set()
-        for e in entropy_set:
-            is_skyline = True
-            if min(e) > m:
-                m = min(e)
-            for e2 in entropy_set:
-                if e != e2 and e[0] <= e2[0] and e[1] <= e2[1]:
-                    is_skyline = False
-                    break
-            if is_skyline:
-                skyline.add(e)
+        # calculate entropies for each signature
+        entropies, by_entropy = self.find_entropies(Q)
 
-        t_hat = None
-        e_hat = None
-        for t, e in entropies.iteritems():
-            condition = (e in skyline and min(e) == m)
-            if t_hat is None or condition:
-                # check if t exists in any queries timed out
-                for cqid in timed_out:
-                    if Query.tuple_in_query(self.db, t, Q[cqid]):
-                        T[t].add(cqid)
-
-                # if it belongs to all, continue
-                if len(T[t]) == len(Q):
-                    del T[t]
-                    del tuples[t]
-                    continue
+        # check if candidates exist in any queries timed out. probing drops any
+        # that belong to all CQs
+        sky, m = skyline(by_entropy.iterkeys())
+        candidates = []
+        for e in sky:
+            if e[0] != m:
+                break
+            candidates.extend(by_entropy[e])
+        t_hat, in_all, probed = self.first_informative_tuple(Q, self.tuples, candidates, timed_out)
 
-                t_hat = t
-                e_hat = e
+        if t_hat is None:
+            # fall back to first informative tuple of any entropy, best entropies first
+            in_all_set = set(in_all)
+            others = [t for e in sorted(by_entropy, reverse=True) for t in by_entropy[e] if t not in in_all_set]
+            t_hat, _, probed = self.first_informative_tuple(Q, self.tuples, others, timed_out)
 
-                if condition:
-                    break
+        e_hat = None
+        if t_hat is not None:
+            e_hat = entropies[t_hat]
         e_time = time.time() - start
         print('Done finding best entropy tuple [{}s].'.format(e_time))
         return t_hat, e_hat, e_time
 
     def execute(self, Q):
-        tuples, valid_cqs, timed_out, sql_errors, query_time = self.run_cqs(Q)
+        tuples = self.sync_state(Q)
+        tuples, valid_cqs, timed_out, sql_errors, query_time = self.run_cqs(Q, tuples=tuples, merged=self.merged)
 
         total_incr_time = 0
         comp_time = 0
         t_hat = None
         t_hat_cqids = None
-        min_objective = 0
-        while not t_hat:
-            if not tuples and timed_out:
-                tuples, incr_time = self.incremental_exec(Q, tuples, timed_out)
+        e_hat = None
+        while t_hat is None:
+            if not self.signatures and timed_out:
+                tuples, incr_time = self.incremental_exec(Q, tuples, timed_out, sql_errors)
                 total_incr_time += incr_time
-            inf_T, inf_counts, inf_time = self.informative_tuples(Q, tuples)
-            comp_time += inf_time
-            t_hat, e_hat, e_time = self.find_best_entropy_tuple(Q, tuples, inf_T, inf_counts, timed_out)
+            if not self.signatures:
+                # no CQ has tuples left to read, nothing tells them apart
+                print('No tuple distinguishes the remaining CQs.')
+                break
+            t_hat, e_hat, e_time = self.find_best_entropy_tuple(Q, timed_out)
             comp_time += e_time
 
-            if t_hat:
+            if t_hat is not None:
                 t_hat_cqids = tuples[t_hat]
 
-        self.print_tuple(t_hat, e_hat, t_hat_cqids)
+        if t_hat is not None:
+            self.print_tuple(t_hat, e_hat, t_hat_cqids)
 
         result_meta = {
             'objective': e_hat,
@@ -362,27 +793,30 @@ class L1S(Base):
 
 class GreedyAll(Base):
     def execute(self, Q):
-        tuples, valid_cqs, timed_out, sql_errors, query_time = self.run_cqs(Q)
+        tuples = self.sync_state(Q)
+        tuples, valid_cqs, timed_out, sql_errors, query_time = self.run_cqs(Q, tuples=tuples, merged=self.merged)
 
         total_incr_time = 0
         comp_time = 0
         t_hat = None
         t_hat_cqids = None
-        min_objective = 0
-        while not t_hat:
-            if not tuples and timed_out:
-                tuples, incr_time = self.incremental_exec(Q, tuples, timed_out)
+        min_objective = None
+        while t_hat is None:
+            if not self.signatures and timed_out:
+                tuples, incr_time = self.incremental_exec(Q, tuples, timed_out, sql_errors)
                 total_incr_time += incr_time
-            objectives, objective_time = self.calc_objectives(Q, tuples)
-            comp_time += objective_time
-            objectives, min_objective_time = self.min_objective_tuples(Q, tuples, objectives, timed_out)
+            if not self.signatures:
+                # no CQ has tuples left to read, nothing tells them apart
+                print('No tuple distinguishes the remaining CQs.')
+                break
+            t_hat, min_objective, min_objective_time = self.min_objective_tuple(Q, timed_out)
             comp_time += min_objective_time
 
-            if objectives:
-                t_hat, min_objective = objectives.iteritems().next()
+            if t_hat is not None:
                 t_hat_cqids = tuples[t_hat]
 
-        self.print_best_tuples(Q, objectives, tuples, TOP_TUPLES)
+        if t_hat is not None:
+            self.print_best_tuples(Q, TOP_TUPLES)
 
         result_meta = {
             'objective': min_objective,
@@ -394,55 +828,66 @@ class GreedyAll(Base):
         return self.return_tuple(Q, t_hat, t_hat_cqids, result_meta)
 
 class GreedyBB(GreedyAll):
-    def branch(self, Q, C, tuples):
+    def __init__(self, db, aig=None, info=None, clique_processes=None, clique_time_budget=None, max_cliques=None):
+        super(GreedyBB, self).__init__(db, aig=aig, info=info)
+
+        # clique search options, see find_cliques
+        self.clique_processes = clique_processes
+        self.clique_time_budget = clique_time_budget
+        self.max_cliques = max_cliques
+        self.clique_fallback = False
+
+        # frozenset of (cqid, weight) -> bitset of the weights of its subsets
+        self.subset_sums = {}
+
+    # pairs each signature S with S plus every clique strictly containing it. cliques
+    # are bitmasks, cq_cliques maps each CQ bit to a bitmask of the cliques
+    # containing it, and covers memoizes the results per signature
+    def branch(self, C, cq_cliques, sigs, covers):
         results = []
-        for cqids in set(frozenset(item) for item in tuples.values()):
-            X = set(cqids)
-            for C_i in C:
-                if cqids < C_i:
-                    X |= C_i
-            results.append((self.bound(Q, cqids, {}), set(cqids), X))
+        for S in sigs:
+            if S not in covers:
+                containing = (1 << len(C)) - 1
+                for i in iter_bits(S):
+                    containing &= cq_cliques[i]
+                X = S
+                for j in iter_bits(containing):
+                    if C[j] != S:
+                        X |= C[j]
+                covers[S] = X
+            results.append((S, covers[S]))
         return results
 
-    # M is a dictionary for memoizing intermediate results
-    def bound(self, Q, S, M):
-        S_w = 0
-        diff_w = 0
-        for cqid, cq in Q.iteritems():
-            if cqid in S:
-                S_w += cq.w
-            else:
-                diff_w += cq.w
-
-        S_key = frozenset(S)
-
-        if diff_w >= S_w:
-            M[S_key] = diff_w - S_w
-        else:
-            if len(S) > BOUND_LIMIT:
-                return 0
-
-            vals = []
-            vals.append(S_w - diff_w)   # base case
-            for C in combinations(S, len(S) - 1):
-                C_key = frozenset(C)
-                if C_key in M:
-                    vals.append(M[C_key])
-                else:
-                    vals.append(self.bound(Q, C, M))
-            M[S_key] = min(vals)
-        return M[S_key]
-
-    def tuples_in_all_and_less_cqs(self, tuples, S):
-        all_cqs = {}
-        less_cqs = {}
-
-        for tuple, cqids in tuples.iteritems():
-            if cqids == S:
-                all_cqs[tuple] = cqids
-            if cqids < S:
-                less_cqs[tuple] = cqids
-        return all_cqs, less_cqs
+    # min over subsets S' of S of |w(S') - w(Q - S')|, found from the sums of weights
+    # reachable by subsets of S, which are memoized for the whole search
+    def bound(self, Q, S):
+        key = frozenset((cqid, Q[cqid].w) for cqid in S if cqid in Q)
+        if key not in self.subset_sums:
+            # bit s is set if some subset of S weighs s
+            sums = 1
+            for cqid, w in key:
+                sums |= sums << w
+            self.subset_sums[key] = sums
+        sums = self.subset_sums[key]
+
+        # reachable sums closest to half the total weight, from below and above
+        total_w = sum(cq.w for cq in Q.itervalues())
+        half = total_w // 2
+        below = sums & ((1 << (half + 1)) - 1)
+        result = total_w - 2 * (below.bit_length() - 1)
+
+        above = sums >> (half + 1)
+        if above:
+            lowest = half + (above & -above).bit_length()
+            result = min(result, 2 * lowest - total_w)
+        return result
+
+    # signature bitmask -> tuples with exactly those CQs
+    def group_by_signature(self, bits):
+        by_sig = {}
+        for S, ts in self.signatures.members.iteritems():
+            by_sig[bits.mask(S)] = ts
+        return by_sig
 
     def construct_qig(self, Q):
         print('Constructing QIG with information: {}'.format(self.info))
@@ -462,16 +907,12 @@ class GreedyBB(GreedyAll):
         print('Finding maximal cliques...')
         start = time.time()
 
-        if hasattr(self, 'cliques'):
-            new_cliques = []
-            for C_i in self.cliques:
-                new_C_i = C_i & set(Q.iterkeys())
-                if new_C_i:
-                    new_cliques.append(new_C_i)
-            self.cliques = new_cliques
-        else:
-            self.cliques = self.qig.find_maximal_cliques()
+        # the QIG keeps its cliques exact as construct_qig removes CQs
+        self.cliques = self.qig.find_maximal_cliques(processes=self.clique_processes, time_budget=self.clique_time_budget, max_cliques=self.max_cliques)
+        self.clique_fallback = self.qig.truncated
         clique_time = time.time() - start
+        if self.clique_fallback:
+            print('Clique budget exceeded, covered remaining CQs greedily.')
         print('Done finding maximal cliques [{}s]'.format(clique_time))
         return self.cliques, clique_time
 
@@ -483,14 +924,27 @@ class GreedyBB(GreedyAll):
 
     def execute(self, Q):
         qig_time = self.construct_qig(Q)
-        P = PriorityQueue()
-        P_dups = set()
         C, clique_time = self.find_maximal_cliques(Q)
 
+        # search nodes are (bound, S, X) with S and X as CQ bitmasks
+        bits = CQBitmask(Q)
+        C_masks = [bits.mask(c) for c in C]
+        cq_cliques = [0] * len(bits.cqids)
+        for j, c in enumerate(C_masks):
+            for i in iter_bits(c):
+                cq_cliques[i] |= 1 << j
+
+        bounds = {}
+        covers = {}
+        P = []
+        P_dups = set()
         for i, c in enumerate(C):
             print('Clique {}: {}'.format(i,c))
-            P.put((self.bound(Q, c, {}), c, c))
-            P_dups.add(frozenset(c))
+            S = C_masks[i]
+            if S not in P_dups:
+                bounds[S] = self.bound(Q, c)
+                heapq.heappush(P, (bounds[S], S, S))
+                P_dups.add(S)
 
         T_hat = {}
         v_hat = 99999999999
@@ -498,39 +952,49 @@ class GreedyBB(GreedyAll):
         total_query_time = 0
         total_objective_time = 0
         total_branch_time = 0
+        expanded = 0
+        pruned = 0
 
-        tuples = {}
-        executed = set()
+        tuples = self.sync_state(Q)
+        by_sig = {}
+        executed = 0
 
-        while not P.empty():
-            (B, S, X) = P.get()
+        while P:
+            (B, S, X) = heapq.heappop(P)
 
             if B >= v_hat:
+                pruned += 1
                 continue
+            expanded += 1
 
-            if not X <= executed:
-                tuples, valid_cqs, timed_out, sql_errors, query_time = self.run_cqs(self.set_to_dict(Q, X), qig=self.qig, tuples=tuples)
+            if X & ~executed:
+                tuples, valid_cqs, timed_out, sql_errors, query_time = self.run_cqs(self.set_to_dict(Q, bits.cqids_of(X)), qig=self.qig, tuples=tuples, merged=self.merged)
                 executed |= X
                 total_query_time += query_time
 
                 if not tuples and timed_out:
-                    tuples, incr_time = self.incremental_exec(Q, tuples, timed_out)
+                    tuples, incr_time = self.incremental_exec(Q, tuples, timed_out, sql_errors)
                     total_query_time += incr_time
 
+                by_sig = self.group_by_signature(bits)
+
             start = time.time()
-            T, U = self.tuples_in_all_and_less_cqs(tuples, S)
-            if T:
-                T_hat = T
-                v_hat = self.objective(Q, S)
+            # tuples in exactly the CQs of S, and signatures strictly within S
+            if S in by_sig:
+                T_hat = dict((t, tuples[t]) for t in by_sig[S])
+                v_hat = self.objective(Q, bits.cqids_of(S))
+            U = [sig for sig in by_sig if sig != S and not sig & ~S]
             total_objective_time += time.time() - start
 
             if U:
                 start = time.time()
-                for item in self.branch(Q, C, U):
+                for S_i, X_i in self.branch(C_masks, cq_cliques, U, covers):
                     print('BRANCHING')
-                    if frozenset(item[1]) not in P_dups:
-                        P.put(item)
-                        P_dups.add(frozenset(item[1]))
+                    if S_i not in P_dups:
+                        if S_i not in bounds:
+                            bounds[S_i] = self.bound(Q, bits.cqids_of(S_i))
+                        heapq.heappush(P, (bounds[S_i], S_i, X_i))
+                        P_dups.add(S_i)
                 total_branch_time += time.time() - start
 
         min_objective = 0
@@ -545,28 +1009,38 @@ class GreedyBB(GreedyAll):
             min_objective = self.objective(Q, t_hat_cqids)
 
         comp_time = qig_time + clique_time + total_objective_time + total_branch_time
+        print('Search nodes expanded: {}, pruned: {}'.format(expanded, pruned))
 
         result_meta = {
             'objective': min_objective,
             'total_cq': len(Q),
-            'exec_cq': len(executed),
+            'exec_cq': bin(executed).count('1'),
             'query_time': total_query_time,
-            'comp_time': comp_time
+            'comp_time': comp_time,
+            'expanded': expanded,
+            'pruned': pruned,
+            'clique_fallback': self.clique_fallback
         }
         return self.return_tuple(Q, t_hat, t_hat_cqids, result_meta)
 
 class GreedyFirst(GreedyBB):
-    def tuples_not_in_future_cliques(self, C, tuples, i):
-        results = {}
-        for t, cqids in tuples.iteritems():
-            exclude = False
-            for j in range(i + 1, len(C)):
-                if cqids <= C[j][1]:
-                    exclude = True
-                    break
-            if not exclude:
-                results[t] = cqids
-        return results
+    # cqid -> bitmask of the positions in C of the cliques containing it
+    def clique_positions(self, C):
+        positions = {}
+        for j, C_info in enumerate(C):
+            for cqid in C_info[1]:
+                positions[cqid] = positions.get(cqid, 0) | (1 << j)
+        return positions
+
+    # whether the CQs S all lie within a single future clique. positions only holds
+    # future cliques, and future is the bitmask of all of them
+    def in_future_clique(self, positions, future, S):
+        containing = future
+        for cqid in S:
+            containing &= positions.get(cqid, 0)
+            if not containing:
+                return False
+        return True
 
     def execute(self, Q):
         qig_time = self.construct_qig(Q)
@@ -576,36 +1050,43 @@ class GreedyFirst(GreedyBB):
 
         for i, c in enumerate(C):
             print('Clique {}: {}'.format(i, c))
-            C_list.append((self.bound(Q, c, {}), c))
+            C_list.append((self.bound(Q, c), c))
         C_list.sort()
 
         total_query_time = 0
-        future_check_time = 0
+        total_objective_time = 0
 
-        tuples = {}
+        tuples = self.sync_state(Q)
         executed = set()
 
+        positions = self.clique_positions(C_list)
+        future = (1 << len(C_list)) - 1
+
         for i, C_info in enumerate(C_list):
             B, C_i = C_info
 
+            # clique i is no longer in the future
+            future &= ~(1 << i)
+            for cqid in C_i:
+                positions[cqid] &= ~(1 << i)
+
             if not C_i <= executed:
-                tuples, valid_cqs, timed_out, sql_errors, query_time = self.run_cqs(self.set_to_dict(Q, C_i), qig=self.qig, tuples=tuples)
+                tuples, valid_cqs, timed_out, sql_errors, query_time = self.run_cqs(self.set_to_dict(Q, C_i), qig=self.qig, tuples=tuples, merged=self.merged)
                 executed |= C_i
                 total_query_time += query_time
 
                 if not tuples and timed_out:
-                    tuples, incr_time = self.incremental_exec(Q, tuples, timed_out)
+                    tuples, incr_time = self.incremental_exec(Q, tuples, timed_out, sql_errors)
                     total_query_time += incr_time
 
-            start = time.time()
-            T = self.tuples_not_in_future_cliques(C_list, tuples, i)
-            future_check_time += time.time() - start
-
-            if T:
-                objectives, calc_objective_time = self.calc_objectives(Q, T)
-                objectives, min_objective_time = self.min_objective_tuples(Q, T, objectives, timed_out)
+            # only tuples whose CQs are not all within a single future clique
+            if self.signatures:
+                t_hat, min_objective, min_objective_time = self.min_objective_tuple(Q, timed_out, accept=lambda S: not self.in_future_clique(positions, future, S))
+                total_objective_time += min_objective_time
+                if t_hat is None:
+                    # every such tuple was in all CQs
+                    continue
 
-                t_hat, min_objective = objectives.iteritems().next()
                 t_hat_cqids = tuples[t_hat]
 
                 self.print_tuple(t_hat, min_objective, t_hat_cqids)
@@ -615,12 +1096,31 @@ class GreedyFirst(GreedyBB):
                     'total_cq': len(Q),
                     'exec_cq': len(executed),
                     'query_time': total_query_time,
-                    'comp_time': qig_time + clique_time + calc_objective_time + min_objective_time + future_check_time
+                    'comp_time': qig_time + clique_time + total_objective_time,
+                    'clique_fallback': self.clique_fallback
                 }
                 return self.return_tuple(Q, t_hat, t_hat_cqids, result_meta)
 
+        # every tuple of every clique was in all CQs, nothing tells them apart
+        print('No tuple distinguishes the remaining CQs.')
+        result_meta = {
+            'objective': None,
+            'total_cq': len(Q),
+            'exec_cq': len(executed),
+            'query_time': total_query_time,
+            'comp_time': qig_time + clique_time + total_objective_time,
+            'clique_fallback': self.clique_fallback
+        }
+        return self.return_tuple(Q, None, None, result_meta)
+
 
 class TopW(Base):
+    def __init__(self, db, aig=None, info=None):
+        super(TopW, self).__init__(db, aig=aig, info=info)
+
+        # tuples found in all CQs, which stay so as feedback only removes CQs
+        self.in_all = set()
+
     # credit: https://gist.github.com/9thbit/1559670/4ee195bdbec43aff58a65b148b11c2ac7d246c11
     def cmp_w_randomize_ties(self, a, b):
         diff = cmp(a, b)
@@ -668,21 +1168,22 @@ class TopW(Base):
                     found = False
 
                     for t in tuple_list:
+                        if t in self.in_all:
+                            continue
                         tuples = { t: set([ int(cqid) ]) }
 
                         # need to check not-yet-executed queries and any timed-out queries
                         check_queries = list(set(Q.iterkeys()) - set(exec_cqs))
                         check_queries.extend(timed_out)
 
-                        for other_cqid in check_queries:
-                            if Query.tuple_in_query(self.db, t, Q[other_cqid]):
-                                tuples[t].add(other_cqid)
+                        check_queries = self.probe_candidates(Q, t, tuples[t], check_queries)
+                        tuples[t] |= Query.queries_containing_tuple(self.db, t, [Q[c] for c in check_queries])
 
                         if tuples[t] != set(Q.iterkeys()):
                             found = True
                             break
                         else:
-                            cq.tuples = None
+                            self.in_all.add(t)
                             tuples = {}
                     if found:
                         break
@@ -693,25 +1194,28 @@ class TopW(Base):
         self.print_stats(exec_cqs, timed_out, sql_errors, valid_cqs, cached)
 
         if not tuples and timed_out:
-            tuples, incr_time = self.incremental_exec(Q, tuples, timed_out)
+            tuples, incr_time = self.incremental_exec(Q, tuples, timed_out, sql_errors)
 
         total_query_time += time.time() - start
 
         t_hat = None
         t_hat_cqids = None
         min_objective = 0
+        objective_time = 0
         if tuples:
-            objectives, calc_objective_time = self.calc_objectives(Q, tuples)
-            objectives, min_objective_time = self.min_objective_tuples(Q, tuples, objectives, [])
-            self.print_best_tuples(Q, objectives, tuples, TOP_TUPLES)
-            t_hat, min_objective = objectives.iteritems().next()
+            start = time.time()
+            # at most the one tuple found, checked against every CQ
+            t_hat = min(tuples, key=lambda t: self.objective(Q, tuples[t]))
             t_hat_cqids = tuples[t_hat]
+            min_objective = self.objective(Q, t_hat_cqids)
+            objective_time = time.time() - start
+            self.print_tuple(t_hat, min_objective, t_hat_cqids)
 
         result_meta = {
             'objective': min_objective,
             'total_cq': len(Q),
             'exec_cq': len(exec_cqs),
             'query_time': total_query_time,
-            'comp_time': calc_objective_time + min_objective_time
+            'comp_time': objective_time
         }
         return self.return_tuple(Q, t_hat, t_hat_cqids, result_meta)
@@ -0,0 +1,256 @@
+__all__ = ['CliqueBudgetExceeded', 'CliqueSet', 'degeneracy_order', 'find_cliques', 'greedy_clique_cover', 'maximal_cliques']
+
+from collections import OrderedDict
+import multiprocessing
+import time
+
+from .membership import iter_bits
+
+# components with more vertices are split into tasks of this many top-level
+# subproblems when enumerated in a process pool
+SPLIT_MIN_VERTICES = 64
+SPLIT_SUBPROBLEMS = 32
+
+# search steps between deadline checks
+DEADLINE_CHECK_STEPS = 1024
+
+class CliqueBudgetExceeded(Exception):
+    pass
+
+def popcount(mask):
+    return bin(mask).count('1')
+
+# vertices of the bitset vertices, repeatedly taking one of least remaining
+# degree. adj[i] is the neighbor bitset of vertex i
+def degeneracy_order(adj, vertices):
+    degrees = {}
+    buckets = {}      # degree -> vertices with that degree
+    for i in iter_bits(vertices):
+        d = popcount(adj[i] & vertices)
+        degrees[i] = d
+        buckets.setdefault(d, set()).add(i)
+
+    order = []
+    remaining = vertices
+    d = 0
+    while remaining:
+        # degrees drop by at most one per removal, so step back once
+        d = max(d - 1, 0)
+        while not buckets.get(d):
+            d += 1
+        i = buckets[d].pop()
+        order.append(i)
+        remaining &= ~(1 << i)
+
+        for j in iter_bits(adj[i] & remaining):
+            buckets[degrees[j]].discard(j)
+            degrees[j] -= 1
+            buckets.setdefault(degrees[j], set()).add(j)
+    return order
+
+# vertex of P | X with the most neighbors in P
+def find_pivot(adj, P, X):
+    max_size = -1
+    max_u = None
+    for u in iter_bits(P | X):
+        size = popcount(P & adj[u])
+        if size > max_size:
+            max_size = size
+            max_u = u
+    return max_u
+
+# top-level subproblems (R, P, X) of the subgraph induced by the bitset vertices,
+# one per vertex in degeneracy order with its later neighbors as P and its
+# earlier neighbors as X
+def subproblems(adj, vertices):
+    results = []
+    earlier = 0
+    for v in degeneracy_order(adj, vertices):
+        bit = 1 << v
+        N = adj[v] & vertices
+        results.append((bit, N & ~earlier, N & earlier))
+        earlier |= bit
+    return results
+
+# yields the maximal cliques containing R within P and none of X, using Tomita's
+# pivoting Bron-Kerbosch with an explicit stack. raises CliqueBudgetExceeded
+# once past deadline
+def expand(adj, R, P, X, deadline=None):
+    if not P:
+        if not X:
+            yield R
+        return
+
+    # frames are (R, P, X, candidates left to branch on)
+    stack = [(R, P, X, P & ~adj[find_pivot(adj, P, X)])]
+    steps = 0
+    while stack:
+        steps += 1
+        if deadline is not None and steps % DEADLINE_CHECK_STEPS == 0 and time.time() > deadline:
+            raise CliqueBudgetExceeded()
+
+        R, P, X, candidates = stack[-1]
+        if not candidates:
+            stack.pop()
+            continue
+
+        low = candidates & -candidates
+        stack[-1] = (R, P & ~low, X | low, candidates & ~low)
+
+        N = adj[low.bit_length() - 1]
+        new_P = P & N
+        new_X = X & N
+        if not new_P:
+            if not new_X:
+                yield R | low
+            continue
+
+        stack.append((R | low, new_P, new_X, new_P & ~adj[find_pivot(adj, new_P, new_X)]))
+
+# yields the maximal cliques of the subgraph induced by the bitset vertices as
+# bitsets. the outer level goes through the vertices in degeneracy order and the
+# inner levels are Tomita's pivoting Bron-Kerbosch, run with an explicit stack
+def maximal_cliques(adj, vertices, deadline=None):
+    for R, P, X in subproblems(adj, vertices):
+        for clique in expand(adj, R, P, X, deadline=deadline):
+            yield clique
+
+# enumerates a list of subproblems, stopping early past deadline or once
+# max_cliques are found. returns (cliques, whether it stopped early)
+def expand_all(task):
+    adj, problems, deadline, max_cliques = task
+    cliques = []
+    try:
+        for R, P, X in problems:
+            for clique in expand(adj, R, P, X, deadline=deadline):
+                cliques.append(clique)
+                if max_cliques is not None and len(cliques) >= max_cliques:
+                    return cliques, True
+    except CliqueBudgetExceeded:
+        return cliques, True
+    return cliques, False
+
+# covers the vertices not in covered with cliques, each grown from the uncovered
+# vertex of highest degree and extended until maximal
+def greedy_clique_cover(adj, vertices, covered=0):
+    cliques = []
+    uncovered = vertices & ~covered
+    while uncovered:
+        v = max(iter_bits(uncovered), key=lambda i: popcount(adj[i] & vertices))
+        R = 1 << v
+        P = adj[v] & vertices
+        while P:
+            # prefer uncovered vertices, then those keeping the most candidates
+            u = max(iter_bits(P), key=lambda i: (uncovered >> i & 1, popcount(adj[i] & P)))
+            R |= 1 << u
+            P &= adj[u]
+        cliques.append(R)
+        uncovered &= ~R
+    return cliques
+
+# tasks for the pool, splitting large components at the top recursion level.
+# each task only carries the adjacency of its own component
+def clique_tasks(adj, components, deadline, max_cliques):
+    tasks = []
+    for vertices in components:
+        sub_adj = dict((i, adj[i] & vertices) for i in iter_bits(vertices))
+        problems = subproblems(sub_adj, vertices)
+        if popcount(vertices) <= SPLIT_MIN_VERTICES:
+            tasks.append((sub_adj, problems, deadline, max_cliques))
+            continue
+        for start in range(0, len(problems), SPLIT_SUBPROBLEMS):
+            tasks.append((sub_adj, problems[start:start + SPLIT_SUBPROBLEMS], deadline, max_cliques))
+    return tasks
+
+# maximal cliques of each component (a bitset of vertices), enumerated in a pool
+# of processes if processes > 1. with a time_budget in seconds or max_cliques,
+# enumeration stops once either is exceeded and the vertices left uncovered by
+# the cliques found so far get a greedy clique cover instead. returns (cliques,
+# whether the fallback was used)
+def find_cliques(adj, components, processes=None, time_budget=None, max_cliques=None):
+    deadline = None
+    if time_budget is not None:
+        deadline = time.time() + time_budget
+
+    tasks = clique_tasks(adj, components, deadline, max_cliques)
+
+    # daemonic processes, like the workers running tasks in main, cannot fork
+    parallel = processes is not None and processes > 1 and len(tasks) > 1
+    if parallel and multiprocessing.current_process().daemon:
+        print('Finding cliques sequentially, clique_processes only applies outside the pool of tasks.')
+        parallel = False
+
+    cliques = []
+    truncated = False
+    pool = None
+    try:
+        if parallel:
+            pool = multiprocessing.Pool(min(processes, len(tasks)))
+            results = pool.imap(expand_all, tasks)
+        else:
+            results = (expand_all(task) for task in tasks)
+
+        for task_cliques, task_truncated in results:
+            cliques.extend(task_cliques)
+            if max_cliques is not None and len(cliques) >= max_cliques:
+                del cliques[max_cliques:]
+                truncated = True
+            truncated = truncated or task_truncated
+            if truncated:
+                break
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    if truncated:
+        covered = 0
+        for clique in cliques:
+            covered |= clique
+        for vertices in components:
+            cliques.extend(greedy_clique_cover(adj, vertices, covered))
+
+    return cliques, truncated
+
+# maximal cliques of a graph as vertex bitsets, kept exact as vertices are
+# removed. every clique of G - D lies in C - D for some maximal clique C of G,
+# so the maximal cliques of G - D are the maximal sets among the C - D. cliques
+# missing D are still maximal, only the shrunk ones need checking
+class CliqueSet(object):
+    def __init__(self, cliques):
+        self.cliques = list(OrderedDict.fromkeys(c for c in cliques if c))
+
+    def __len__(self):
+        return len(self.cliques)
+
+    def remove(self, removed):
+        kept = []
+        shrunk = []
+        for c in self.cliques:
+            if c & removed:
+                shrunk.append(c & ~removed)
+            else:
+                kept.append(c)
+        if not shrunk:
+            return
+
+        shrunk = [c for c in OrderedDict.fromkeys(shrunk) if c]
+        candidates = kept + shrunk
+
+        # vertex -> bitset of the candidates containing it
+        containing = {}
+        for j, c in enumerate(candidates):
+            for i in iter_bits(c):
+                containing[i] = containing.get(i, 0) | (1 << j)
+
+        # a shrunk clique is kept if no other candidate contains it
+        for j, c in enumerate(shrunk, len(kept)):
+            others = ~(1 << j)
+            for i in iter_bits(c):
+                others &= containing[i]
+                if not others:
+                    break
+            if not others:
+                kept.append(c)
+
+        self.cliques = kept
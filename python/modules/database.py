@@ -1,12 +1,62 @@
-__all__ = ['Database']
+__all__ = ['Database', 'QueryTimeout', 'TupleCodec', 'data_version']
 
+import hashlib
 import os
 import pickle
+import Queue
 import re
+import tempfile
+import threading
 import time
+import weakref
+
+from collections import OrderedDict
+from contextlib import contextmanager
 
 import mysql.connector
 
+# max incremental streams kept open, each holding its own connection
+INCREMENTAL_MAX_STREAMS = 8
+# seconds the server waits on an incremental stream that is not being read
+INCREMENTAL_NET_WRITE_TIMEOUT = 86400
+
+# text values that collation_key can key
+PRINTABLE_ASCII_RE = re.compile(r'[\x20-\x7e]*\Z')
+
+# key under which values equal in MySQL's case insensitive, trailing space padded
+# text comparison are equal. only printable ASCII is keyed, since collations
+# match other characters in ways that differ between them (sharp s equals 'ss'
+# or 's', control characters are ignored), so None means it can't be ruled out
+def collation_key(val):
+    if isinstance(val, str):
+        try:
+            val = val.decode('ascii')
+        except UnicodeDecodeError:
+            return None
+    if not isinstance(val, unicode) or not PRINTABLE_ASCII_RE.match(val):
+        return None
+    return val.lower().rstrip()
+
+# fingerprint of the tables' contents, changes whenever a table is modified.
+# uses CHECKSUM TABLE, since the sizes and update times in information_schema
+# are estimates and may be cached for a day on MySQL 8. this scans every table,
+# so a run computes it once and passes it to each task's Database
+def data_version(user, pw, host, db):
+    conn = mysql.connector.connect(user=user, password=pw, host=host, database=db)
+    try:
+        cursor = conn.cursor()
+        cursor.execute('SHOW TABLES')
+        tables = sorted(row[0] for row in cursor.fetchall())
+
+        rows = []
+        if tables:
+            cursor.execute('CHECKSUM TABLE {}'.format(', '.join('`{}`'.format(t) for t in tables)))
+            rows = sorted(cursor.fetchall())
+        cursor.close()
+    finally:
+        conn.close()
+    return hashlib.sha1(repr(rows)).hexdigest()
+
 class AttributeIntersect(object):
     def __init__(self, type, vals=[], min=None, max=None):
         self.type = type
@@ -67,6 +117,26 @@ class AttributeIntersect(object):
         elif self.type == 'text':
             return set(self.vals) <= set(other.vals)
 
+    def contains(self, val):
+        if self.is_all():
+            return True
+
+        if self.is_empty():
+            return False
+
+        if self.type == 'num':
+            return self.min <= val <= self.max
+        elif self.type == 'text':
+            if not hasattr(self, 'keys'):
+                self.keys = set(collation_key(v) for v in self.vals)
+                if None in self.keys:
+                    # some value may equal others it isn't keyed like
+                    self.keys = None
+            if self.keys is None:
+                return True
+            key = collation_key(val)
+            return key is None or key in self.keys
+
 # case that all values intersect (e.g. attribute is intersected with self)
 class AllAttributeIntersect(AttributeIntersect):
     def __init__(self, type):
@@ -166,26 +236,259 @@ def convert_mysql_type(mysql_type):
     else:
         return mysql_type, None
 
+# bits per value id in encoded tuples
+TUPLE_ID_BITS = 32
+TUPLE_ID_MASK = (1 << TUPLE_ID_BITS) - 1
+
+# encodes result tuples as ints, with a dictionary of values per tuple position.
+# ids are packed TUPLE_ID_BITS apart under a leading bit marking the arity, so
+# tuples of different arities never share a key. keys are only valid within
+# the process that made them
+class TupleCodec(object):
+    def __init__(self):
+        self.ids = []       # position -> value -> id
+        self.values = []    # position -> id -> value
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return sum(len(values) for values in self.values)
+
+    def encode_unlocked(self, t):
+        while len(self.ids) < len(t):
+            self.ids.append({})
+            self.values.append([])
+
+        key = 1
+        for i in range(len(t) - 1, -1, -1):
+            ids = self.ids[i]
+            id = ids.get(t[i])
+            if id is None:
+                id = len(self.values[i])
+                ids[t[i]] = id
+                self.values[i].append(t[i])
+            key = (key << TUPLE_ID_BITS) | id
+        return key
+
+    def encode(self, t):
+        with self.lock:
+            return self.encode_unlocked(t)
+
+    def encode_all(self, ts):
+        with self.lock:
+            return set(self.encode_unlocked(t) for t in ts)
+
+    def decode(self, key):
+        t = []
+        i = 0
+        while key > 1:
+            t.append(self.values[i][key & TUPLE_ID_MASK])
+            key >>= TUPLE_ID_BITS
+            i += 1
+        return tuple(t)
+
+    def decode_all(self, keys):
+        return set(self.decode(key) for key in keys)
+
+class QueryTimeout(Exception):
+    def __init__(self, partial=None):
+        super(QueryTimeout, self).__init__('Timeout: Query timed out.')
+        self.partial = partial    # tuples read before timing out
+
+# memoized results of tuple membership probes, keyed by (tuple, query fingerprint)
+class ProbeCache(object):
+    def __init__(self, path=None):
+        self.path = path      # only persisted if path is set
+        self.results = {}
+        self.hits = 0
+        self.misses = 0
+        self.skipped = 0      # probes ruled out locally without querying
+
+        if self.path and os.path.exists(self.path):
+            self.results = pickle.load(open(self.path, 'rb'))
+
+    def __unicode__(self):
+        return u'{} hits, {} misses, {} skipped, {} cached'.format(self.hits, self.misses, self.skipped, len(self.results))
+
+    def __str__(self):
+        return unicode(self).encode('utf-8')
+
+    def key(self, t, query):
+        canonical = tuple(v.decode('utf-8') if isinstance(v, str) else v for v in t)
+        return canonical, query.get_fingerprint()
+
+    def get(self, t, query):
+        result = self.results.get(self.key(t, query))
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return result
+
+    def put(self, t, query, result):
+        self.results[self.key(t, query)] = result
+
+    def save(self):
+        if not self.path:
+            return
+
+        # merge with results saved by other processes, then atomically replace
+        results = {}
+        if os.path.exists(self.path):
+            results = pickle.load(open(self.path, 'rb'))
+        results.update(self.results)
+
+        tmp_path = '{}.{}'.format(self.path, os.getpid())
+        pickle.dump(results, open(tmp_path, 'wb'))
+        os.rename(tmp_path, self.path)
+
+# on-disk cache of CQ results shared by all processes, one file per query
+# fingerprint under a directory for the database and the version of its data
+class ResultCache(object):
+    def __init__(self, cache_dir, db_name, data_version, timeout=None):
+        self.dir = os.path.join(cache_dir, db_name, data_version)
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+
+        if not os.path.exists(self.dir):
+            try:
+                os.makedirs(self.dir)
+            except OSError:
+                # created by another process in the meantime
+                pass
+
+    def __unicode__(self):
+        return u'{} hits, {} misses'.format(self.hits, self.misses)
+
+    def __str__(self):
+        return unicode(self).encode('utf-8')
+
+    def path(self, fingerprint):
+        return os.path.join(self.dir, fingerprint + '.pkl')
+
+    # returns cached entry, or None if missing or timed out under a shorter timeout
+    def get(self, fingerprint):
+        entry = None
+        try:
+            with open(self.path(fingerprint), 'rb') as f:
+                entry = pickle.load(f)
+        except (IOError, EOFError, pickle.UnpicklingError):
+            pass
+
+        if entry is not None and entry.get('fingerprint') != fingerprint:
+            entry = None
+
+        if entry is not None and entry['timed_out']:
+            if self.timeout is None or entry['timeout'] is None or entry['timeout'] < self.timeout:
+                entry = None
+
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    def put(self, fingerprint, query_str, tuples, timed_out=False):
+        entry = {
+            'fingerprint': fingerprint,
+            'query': query_str,
+            'tuples': tuples,
+            'timed_out': timed_out,
+            'timeout': self.timeout
+        }
+
+        # write to a temp file and rename, so readers never see partial files
+        fd, tmp_path = tempfile.mkstemp(dir=self.dir)
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(entry, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, self.path(fingerprint))
+
+# fixed set of extra connections for executing CQs concurrently
+class ConnectionPool(object):
+    def __init__(self, size, connect):
+        self.size = size
+        self.conns = Queue.Queue()
+        for i in range(size):
+            self.conns.put(connect())
+
+    @contextmanager
+    def connection(self):
+        conn = self.conns.get()
+        try:
+            yield conn
+        finally:
+            self.conns.put(conn)
+
 class Database(object):
     # relations to ignore from db
     IGNORE_RELS = ['size', 'history', 'ids']
+    # max server-side prepared statements kept open on the connection
+    PREPARED_LIMIT = 2000
 
-    def __init__(self, user, pw, host, db, cache_dir, timeout=None, buffer_pool_size=None):
+    def __init__(self, user, pw, host, db, cache_dir, timeout=None, buffer_pool_size=None, pool_size=None, persist_probes=False, keep_partial=False, result_cache_dir=None, data_version=None):
         print("Loading database...")
         start = time.time()
-        self.conn = mysql.connector.connect(user=user, password=pw, host=host, database=db)
+        self.connect_args = dict(user=user, password=pw, host=host, database=db)
+        self.timeout = timeout
+        self.conn = mysql.connector.connect(**self.connect_args)
         self.name = db
         self.cache_path = os.path.join(cache_dir, db + '.cache')
 
+        self.prepared = OrderedDict()     # sql -> prepared cursor
+        self.streams = OrderedDict()      # id -> open IncrementalCursor, least recently read first
+        self.unpreparable = set()         # sql that failed as a prepared statement
+
+        # result tuples are kept as int keys, decoded when probed or shown
+        self.codec = TupleCodec()
+
+        # fingerprint -> estimated cost, shared by equivalent CQs. saved to
+        # costs_path when a task ends, so later tasks and runs on the database
+        # reuse them
+        self.costs_path = os.path.join(cache_dir, db + '.costs')
+        self.costs = {}
+        if os.path.exists(self.costs_path):
+            self.costs = pickle.load(open(self.costs_path, 'rb'))
+        # fingerprint -> last executed CQ, whose result equivalent CQs in the task
+        # reuse. other tasks share results through the result cache
+        self.executed = weakref.WeakValueDictionary()
+
+        # keep tuples of CQs that time out part way through
+        self.keep_partial = keep_partial
+
+        if persist_probes:
+            self.probe_cache = ProbeCache(os.path.join(cache_dir, db + '.probes'))
+        else:
+            self.probe_cache = ProbeCache()
+
         loaded_from_cache = self.load_relations()
         if timeout is not None:
             self.set_timeout(timeout)
         # if buffer_pool_size is not None:
             # self.set_buffer_pool_size(buffer_pool_size)
         self.set_packet_size()
+
+        # results shared between runs, invalidated when the data changes
+        self.result_cache = None
+        if result_cache_dir and data_version is not None:
+            if timeout is not None:
+                timeout = int(timeout)
+            self.result_cache = ResultCache(result_cache_dir, db, data_version, timeout=timeout)
+
+        # pool of connections for concurrent CQ execution, only if size > 1
+        self.pool = None
+        if pool_size is not None and int(pool_size) > 1:
+            self.pool = ConnectionPool(int(pool_size), self.connect)
+            print("Opened connection pool of size {}".format(self.pool.size))
         print("Loaded from cache: {}".format(loaded_from_cache))
         print("Done loading database [{}s]".format(time.time()-start))
 
+    # new connection with the session settings of the main one
+    def connect(self):
+        conn = mysql.connector.connect(**self.connect_args)
+        if self.timeout is not None:
+            self.set_timeout(self.timeout, conn=conn)
+        return conn
+
     def load_cache(self):
         if os.path.exists(self.cache_path):
             self.relations = pickle.load(open(self.cache_path, 'rb'))
@@ -195,6 +498,17 @@ class Database(object):
     def save_cache(self):
         pickle.dump(self.relations, open(self.cache_path, 'wb'))
 
+    def save_costs(self):
+        # merge with costs saved by other processes, then atomically replace
+        costs = {}
+        if os.path.exists(self.costs_path):
+            costs = pickle.load(open(self.costs_path, 'rb'))
+        costs.update(self.costs)
+
+        tmp_path = '{}.{}'.format(self.costs_path, os.getpid())
+        pickle.dump(costs, open(tmp_path, 'wb'))
+        os.rename(tmp_path, self.costs_path)
+
     def load_relations(self):
         if self.load_cache():
             return True
@@ -242,8 +556,36 @@ class Database(object):
 
         return False
 
-    def cursor(self):
-        return self.conn.cursor()
+    def cursor(self, conn=None):
+        if conn is None:
+            conn = self.conn
+        return conn.cursor()
+
+    # cursor that keeps sql prepared on the server for repeated executions, or
+    # None if sql already failed as a prepared statement
+    def prepared_cursor(self, sql):
+        if sql in self.unpreparable:
+            return None
+        if sql in self.prepared:
+            return self.prepared[sql]
+
+        if len(self.prepared) >= self.PREPARED_LIMIT:
+            # deallocate least recently prepared statement
+            old_sql, old_cursor = self.prepared.popitem(last=False)
+            old_cursor.close()
+
+        self.prepared[sql] = self.conn.cursor(prepared=True)
+        return self.prepared[sql]
+
+    # closes the prepared cursor for sql and stops preparing it
+    def discard_prepared(self, sql):
+        self.unpreparable.add(sql)
+        cursor = self.prepared.pop(sql, None)
+        if cursor is not None:
+            try:
+                cursor.close()
+            except Exception:
+                pass
 
     def set_packet_size(self):
         cursor = self.cursor()
@@ -254,8 +596,8 @@ class Database(object):
         cursor.execute('SET GLOBAL MAX_ALLOWED_PACKET={}'.format(1000000000))
         cursor.close()
 
-    def set_timeout(self, timeout):
-        cursor = self.cursor()
+    def set_timeout(self, timeout, conn=None):
+        cursor = self.cursor(conn)
         cursor.execute('SET SESSION MAX_EXECUTION_TIME={}'.format(timeout))
         cursor.close()
 
@@ -375,64 +717,183 @@ class Database(object):
     def get_relations(self):
         return self.relations
 
-    def execute_sql(self, sql):
-        cursor = self.cursor()
+    # streams rows into the set of encoded tuples as they arrive. if keep_partial is
+    # set and the query times out, the tuples read so far are attached to the exception
+    def execute_sql(self, sql, conn=None, keep_partial=False):
+        cursor = self.cursor(conn)
+        query_tuples = set()
         try:
             cursor.execute(sql)
 
-            query_tuples = set()
             for result in cursor:
                 # disallow nulls
                 if None in result:
                     continue
 
-                query_tuples.add(result)
+                query_tuples.add(self.codec.encode(result))
             cursor.close()
             return query_tuples
         except Exception as e:
             cursor.close()
             if str(e).startswith('3024'):
-                raise Exception('Timeout: Query timed out.')
+                if keep_partial and query_tuples:
+                    raise QueryTimeout(query_tuples)
+                raise QueryTimeout()
             raise e
 
-    def execute_incremental(self, cq):
-        if cq.cached:
-            if cq.tuples:
-                return list(cq.tuples)[0]
-            else:
-                return None
-
-        offset_str = cq.query_str + ' LIMIT 1 OFFSET {}'.format(cq.offset)
-        cq.offset += 1
+    # connection for an incremental stream. the stream is kept open across reads,
+    # so it has no execution limit of its own and each call on it is bounded by
+    # stream_call instead. the server waits for reads across algorithm iterations
+    def connect_stream(self):
+        conn = mysql.connector.connect(**self.connect_args)
+        cursor = self.cursor(conn)
+        cursor.execute('SET SESSION MAX_EXECUTION_TIME=0')
+        cursor.execute('SET SESSION NET_WRITE_TIMEOUT={}'.format(INCREMENTAL_NET_WRITE_TIMEOUT))
+        cursor.close()
+        return conn
+
+    # runs fn on the stream of incr, killing the stream's query from the main
+    # connection if fn runs past the timeout. returns (result of fn, whether the
+    # query was killed), with None as the result if fn failed from being killed
+    def stream_call(self, incr, fn):
+        if self.timeout is None:
+            return fn(), False
+
+        lock = threading.Lock()
+        state = {'done': False, 'killed': False}
+
+        def kill():
+            with lock:
+                if state['done']:
+                    return
+                state['killed'] = True
+                try:
+                    cursor = self.cursor()
+                    cursor.execute('KILL QUERY {}'.format(incr.conn.connection_id))
+                    cursor.close()
+                except Exception:
+                    pass
+
+        timer = threading.Timer(int(self.timeout) / 1000.0, kill)
+        timer.start()
+        result = None
+        error = None
         try:
-            cq.cached = True
-            cq.tuples = self.execute_sql(offset_str)
-            result = list(cq.tuples)[0]
+            result = fn()
         except Exception as e:
-            cq.cached = True
-            cq.tuples = set()
-            result = None
-
-        return result
-
-    def execute(self, cq):
+            error = e
+
+        with lock:
+            state['done'] = True
+        timer.cancel()
+
+        if error is not None and not state['killed']:
+            raise error
+        return result, state['killed']
+
+    # opens a stream over the rows of cq, closing the least recently read one if
+    # too many are open. a reopened stream starts over and skips seen tuples.
+    # returns whether the query was killed before returning its first rows
+    def open_stream(self, cq, incr):
+        while len(self.streams) >= INCREMENTAL_MAX_STREAMS:
+            old_id, old = self.streams.popitem(last=False)
+            old.close()
+
+        incr.conn = self.connect_stream()
+        incr.cursor = incr.conn.cursor()
+        self.streams[id(incr)] = incr
+        return self.stream_call(incr, lambda: incr.cursor.execute(cq.query_str))[1]
+
+    # returns the next unconsumed tuple of cq, reading rows in growing batches
+    # from where the previous read stopped. each read is bounded by the timeout.
+    # returns None once all rows are read, or if the stream stopped on a timeout
+    # or error, which is recorded on the cursor
+    def execute_incremental(self, cq):
+        incr = cq.get_incremental()
+
+        while not incr.buffer and not incr.stopped():
+            rows = None
+            try:
+                if not incr.is_open():
+                    killed = self.open_stream(cq, incr)
+                else:
+                    # mark as most recently read
+                    self.streams[id(incr)] = self.streams.pop(id(incr))
+                    killed = False
+                if not killed:
+                    rows, killed = self.stream_call(incr, lambda: incr.cursor.fetchmany(incr.batch_size))
+            except Exception as e:
+                incr.error = e
+                print('Incremental execution of CQ {} stopped: {}'.format(cq.cqid, e))
+                self.close_stream(incr)
+                break
+
+            if rows is not None:
+                incr.add(rows, self.codec)
+            if killed:
+                # the killed query can't be read further, a later round starts over
+                incr.timed_out = True
+                print('Incremental execution of CQ {} timed out.'.format(cq.cqid))
+                self.close_stream(incr)
+            elif incr.exhausted:
+                self.close_stream(incr)
+
+        if incr.buffer:
+            return incr.buffer[0]
+        return None
+
+    def close_stream(self, incr):
+        self.streams.pop(id(incr), None)
+        incr.close()
+
+    def execute(self, cq, conn=None):
         query_str = cq.query_str
+        fingerprint = cq.get_fingerprint()
 
         if cq.cached:
             return cq.tuples, True
         elif cq.timed_out:
             return None, False
 
+        # equivalent CQ already executed, share its tuples
+        other = self.executed.get(fingerprint)
+        if other is not None and other is not cq and (other.cached or other.timed_out):
+            return self.set_result(cq, other.tuples, other.timed_out), True
+        self.executed[fingerprint] = cq
+
+        if self.result_cache is not None:
+            entry = self.result_cache.get(fingerprint)
+            if entry is not None:
+                query_tuples = entry['tuples']
+                if query_tuples is not None:
+                    query_tuples = self.codec.encode_all(query_tuples)
+                return self.set_result(cq, query_tuples, entry['timed_out']), True
+
         try:
-            query_tuples = self.execute_sql(query_str)
+            query_tuples = self.execute_sql(query_str, conn=conn, keep_partial=self.keep_partial)
+            timed_out = False
+        except QueryTimeout as e:
+            query_tuples = e.partial
+            timed_out = True
+
+        if self.result_cache is not None:
+            # keys are local to this process, the cache stores values
+            decoded = None
+            if query_tuples is not None:
+                decoded = self.codec.decode_all(query_tuples)
+            self.result_cache.put(fingerprint, query_str, decoded, timed_out=timed_out)
+
+        return self.set_result(cq, query_tuples, timed_out), False
+
+    def set_result(self, cq, query_tuples, timed_out):
+        if timed_out:
+            cq.timed_out = True
+            if not query_tuples or not self.keep_partial:
+                return None
 
-            cq.cached = True
-            cq.tuples = query_tuples
+            # keep tuples read before timing out, cq remains timed out
+            cq.partial = True
 
-            return query_tuples, False
-        except Exception as e:
-            if str(e).startswith('Timeout'):
-                cq.timed_out = True
-                return None, False
-            else:
-                raise e
+        cq.cached = True
+        cq.tuples = query_tuples
+        return query_tuples
@@ -0,0 +1,92 @@
+__all__ = ['CQBitmask', 'MembershipMatrix', 'iter_bits']
+
+import numpy as np
+
+# max cells of a dense tuples x CQs block expanded from the packed bits at once
+MEMBERSHIP_CHUNK_CELLS = 1 << 22
+
+# tuple -> CQ membership, with CQs mapped to dense column indices and the CQs
+# of each tuple stored as a row of packed bits
+class MembershipMatrix(object):
+    def __init__(self, Q, T):
+        self.cqids = sorted(Q.iterkeys())
+        self.index = dict((cqid, i) for i, cqid in enumerate(self.cqids))
+
+        # rows per dense block, so blocks stay the same size whatever the CQ count
+        self.chunk_rows = max(1, MEMBERSHIP_CHUNK_CELLS // max(1, len(self.cqids)))
+
+        self.tuples = list(T.iterkeys())
+
+        chunks = []
+        for start in range(0, len(self.tuples), self.chunk_rows):
+            ts = self.tuples[start:start + self.chunk_rows]
+            rows = []
+            cols = []
+            for r, t in enumerate(ts):
+                for cqid in T[t]:
+                    if cqid in self.index:
+                        rows.append(r)
+                        cols.append(self.index[cqid])
+
+            dense = np.zeros((len(ts), len(self.cqids)), dtype=np.bool_)
+            dense[rows, cols] = True
+            chunks.append(np.packbits(dense, axis=1))
+
+        if chunks:
+            self.bits = np.concatenate(chunks)
+        else:
+            self.bits = np.zeros((0, (len(self.cqids) + 7) // 8), dtype=np.uint8)
+
+        self.unique = None      # distinct rows of bits
+        self.inverse = None     # tuple row -> its row in unique
+
+    def __len__(self):
+        return len(self.tuples)
+
+    # distinct CQ sets of the tuples, and the index of each tuple's set among them
+    def signatures(self):
+        if self.unique is None:
+            if len(self.tuples) and self.bits.shape[1]:
+                self.unique, self.inverse = np.unique(self.bits, axis=0, return_inverse=True)
+            else:
+                # no tuples or no CQs, every tuple has the same empty set
+                self.unique = self.bits[:1]
+                self.inverse = np.zeros(len(self.tuples), dtype=np.intp)
+        return self.unique, self.inverse
+
+    # values.dot(row) for each tuple, computed once per distinct CQ set
+    def per_signature(self, values):
+        unique, inverse = self.signatures()
+        results = np.zeros(len(unique), dtype=values.dtype)
+        for start in range(0, len(unique), self.chunk_rows):
+            end = start + self.chunk_rows
+            dense = np.unpackbits(unique[start:end], axis=1)[:, :len(self.cqids)]
+            results[start:end] = dense.astype(values.dtype).dot(values)
+        return results[inverse]
+
+    # CQs of each tuple as an integer with bit i set for column i, needs < 63 CQs
+    def masks(self):
+        return self.per_signature(np.left_shift(1, np.arange(len(self.cqids), dtype=np.int64)))
+
+# yields the positions of the set bits of mask, lowest first
+def iter_bits(mask):
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+# CQs of Q mapped to bit positions, for handling sets of cqids as int bitmasks
+class CQBitmask(object):
+    def __init__(self, Q):
+        self.cqids = sorted(Q.iterkeys())
+        self.index = dict((cqid, i) for i, cqid in enumerate(self.cqids))
+
+    def mask(self, S):
+        mask = 0
+        for cqid in S:
+            if cqid in self.index:
+                mask |= 1 << self.index[cqid]
+        return mask
+
+    def cqids_of(self, mask):
+        return set(self.cqids[i] for i in iter_bits(mask))
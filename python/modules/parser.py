@@ -1,26 +1,182 @@
 __all__ = ['SQLParser']
 
+import hashlib
 import os
 import pickle
 import re
 import time
 import traceback
 
+from collections import OrderedDict
+from itertools import islice, permutations, product
 from moz_sql_parser import parse
 # from tqdm import tqdm
 
 from .query import Query
 
+# operators whose operands can be reordered
+COMMUTATIVE_OPS = set(['eq', 'neq', 'and', 'or', 'add', 'mul'])
+# comparisons rewritten to their mirror with swapped operands
+MIRRORED_OPS = {'gt': 'lt', 'gte': 'lte'}
+# FROM entries joined with an ON condition that behaves like a WHERE predicate
+INNER_JOIN_KEYS = ['join', 'inner join']
+# max alias orderings compared when some aliases cannot be told apart
+CANONICAL_ORDERINGS = 720
+
+# renders a parse tree node, renaming the aliases in names
+def render(node, names):
+    if isinstance(node, basestring):
+        if '.' in node:
+            alias, col = node.split('.', 1)
+            if alias.lower() in names:
+                return u'{}.{}'.format(names[alias.lower()], col.lower())
+        return node.lower()
+    elif isinstance(node, list):
+        return u'[{}]'.format(u','.join(render(n, names) for n in node))
+    elif isinstance(node, dict):
+        if node.keys() == ['literal']:
+            val = node['literal']
+            if isinstance(val, basestring):
+                val = unicode(val)
+            return u'L{!r}'.format(val)
+
+        items = []
+        for op, args in sorted(node.items()):
+            if op in MIRRORED_OPS and isinstance(args, list) and len(args) == 2:
+                op, args = MIRRORED_OPS[op], args[::-1]
+            if isinstance(args, list):
+                rendered = [render(arg, names) for arg in args]
+                if op in COMMUTATIVE_OPS:
+                    rendered.sort()
+                items.append(u'{}({})'.format(op, u','.join(rendered)))
+            else:
+                items.append(u'{}({})'.format(op, render(args, names)))
+        return u'{{{}}}'.format(u','.join(items))
+    else:
+        return repr(node)
+
+# aliases in names referenced anywhere under node
+def aliases_in(node, names):
+    found = set()
+    if isinstance(node, basestring):
+        if '.' in node and node.split('.', 1)[0].lower() in names:
+            found.add(node.split('.', 1)[0].lower())
+    elif isinstance(node, list):
+        for n in node:
+            found |= aliases_in(n, names)
+    elif isinstance(node, dict) and node.keys() != ['literal']:
+        for n in node.values():
+            found |= aliases_in(n, names)
+    return found
+
+# string shared by CQs that differ only in alias names, join order or predicate
+# order, or None if the query has clauses that are not handled
+def canonical_form(parsed):
+    if 'from' not in parsed or 'select' not in parsed:
+        return None
+    froms = parsed['from']
+    if not isinstance(froms, list):
+        froms = [froms]
+
+    tables = OrderedDict()    # alias -> relation name
+    conds = []
+    for rel in froms:
+        if isinstance(rel, dict):
+            for key in INNER_JOIN_KEYS:
+                if key in rel:
+                    if not set(rel.keys()) <= set([key, 'on']):
+                        return None
+                    if 'on' in rel:
+                        conds.append(rel['on'])
+                    rel = rel[key]
+                    break
+
+        if isinstance(rel, basestring):
+            table, alias = rel, rel
+        elif isinstance(rel, dict) and isinstance(rel.get('value'), basestring) and set(rel.keys()) <= set(['value', 'name']):
+            table, alias = rel['value'], rel.get('name', rel['value'])
+        else:
+            # outer joins, subqueries, USING
+            return None
+
+        if not isinstance(alias, basestring) or alias.lower() in tables:
+            return None
+        tables[alias.lower()] = table.lower()
+
+    if 'where' in parsed:
+        conds.append(parsed['where'])
+
+    conjuncts = []
+    while conds:
+        cond = conds.pop()
+        if isinstance(cond, dict) and cond.keys() == ['and']:
+            conds.extend(cond['and'])
+        else:
+            conjuncts.append(cond)
+
+    rest = dict((k, v) for k, v in parsed.items() if k not in ('select', 'from', 'where'))
+
+    # refine alias labels by their relation and the predicates and projections
+    # they take part in, until the aliases stop splitting into finer groups
+    mentions = [aliases_in(c, tables) for c in conjuncts]
+    labels = dict((a, tables[a]) for a in tables)
+    for i in range(len(tables)):
+        refined = {}
+        for a in tables:
+            names = dict((b, u'<{}>'.format(labels[b])) for b in tables)
+            names[a] = u'?'
+            sig = [labels[a], render(parsed['select'], names), render(rest, names)]
+            sig.extend(sorted(render(c, names) for c, m in zip(conjuncts, mentions) if a in m))
+            refined[a] = hashlib.sha1(repr(sig)).hexdigest()
+        stable = len(set(refined.values())) == len(set(labels.values()))
+        labels = refined
+        if stable:
+            break
+
+    groups = OrderedDict()
+    for a in sorted(tables, key=lambda a: labels[a]):
+        groups.setdefault(labels[a], []).append(a)
+
+    # number aliases by label, trying the orders of indistinguishable ones
+    best = None
+    orderings = product(*[permutations(g) for g in groups.values()])
+    for ordering in islice(orderings, CANONICAL_ORDERINGS):
+        names = {}
+        for group in ordering:
+            for a in group:
+                names[a] = u't{}'.format(len(names))
+
+        form = u'select {} from {} where {} {}'.format(
+            render(parsed['select'], names),
+            u','.join(sorted(u'{} {}'.format(tables[a], names[a]) for a in tables)),
+            u' and '.join(sorted(render(c, names) for c in conjuncts)),
+            render(rest, names))
+        if best is None or form < best:
+            best = form
+    return best
+
+def fingerprint(parsed):
+    try:
+        form = canonical_form(parsed)
+    except Exception:
+        form = None
+    if form is None:
+        return None
+    return hashlib.sha1(form.encode('utf-8')).hexdigest()
+
 class SQLParser(object):
     def __init__(self, db_name, cache_dir):
         self.db_name = db_name
         self.cache_dir = cache_dir
         self.cache = {}
+        # set when cached queries were given missing fingerprints
+        self.upgraded = False
 
     def cache_path(self, qid):
         return os.path.join(self.cache_dir, '{}.{}.cache'.format(self.db_name, qid))
 
     def load_cache(self, qid):
+        self.upgraded = False
         if os.path.exists(self.cache_path(qid)):
             with open(self.cache_path(qid), 'rb') as f:
                 self.cache = pickle.load(f)
@@ -30,18 +186,22 @@ class SQLParser(object):
             return False
 
     def update_cache(self, query):
-        copy = Query(query.cqid, query.query_str, query.projs, query.preds)
+        copy = Query(query.cqid, query.query_str, query.projs, query.preds, fingerprint=query.fingerprint)
         self.cache[query.query_str] = copy
 
     def flush_cache(self, qid):
-        if not os.path.exists(self.cache_path(qid)):
+        if self.upgraded or not os.path.exists(self.cache_path(qid)):
             pickle.dump(self.cache, open(self.cache_path(qid), 'wb'))
 
     def parse_one(self, qid, cqid, query_str):
         if query_str in self.cache:
             cached = self.cache[query_str]
-            cached.cqid = cqid
-            return cached, True
+            if not hasattr(cached, 'fingerprint'):
+                cached.fingerprint = fingerprint(parse(query_str))
+                self.upgraded = True
+            # separate copy per cqid, CQs with the same text must not share cqids
+            copy = Query(cqid, query_str, cached.projs, cached.preds, fingerprint=cached.fingerprint)
+            return copy, True
 
         parsed = parse(query_str)
 
@@ -59,7 +219,7 @@ class SQLParser(object):
             for op, vals in parsed['where'].items():
                 preds.append((op, vals))
 
-        query = Query(cqid, query_str, projs, preds)
+        query = Query(cqid, query_str, projs, preds, fingerprint=fingerprint(parsed))
 
         self.update_cache(query)
         return query, False
@@ -88,13 +248,14 @@ class SQLParser(object):
             # bar.update(1)
         # bar.close()
 
-        if not cache_loaded:
+        if not cache_loaded or self.upgraded:
             print('Flushing cache...')
             self.flush_cache(qid)
             print('Done flushing cache.')
 
         parse_time = time.time() - start
         print("From cache: {}/{}".format(from_cache, len(query_strs)))
+        print("Distinct CQs: {}/{}".format(len(set(q.get_fingerprint() for q in queries.values())), len(query_strs)))
         print("Parse errors: {}/{}".format(len(errors), len(query_strs)))
         print("Done parsing [{}s]".format(parse_time))
         return queries
@@ -1,39 +1,47 @@
+from itertools import product
+
+from .cliques import CliqueSet, find_cliques
 from .database import AttributeIntersect, AllAttributeIntersect
+from .membership import iter_bits
 from .partitions import PartSet, SinglePart
 
-# Query Intersection Graph
+# Query Intersection Graph. vertices are numbered as they are added and each
+# vertex's neighbors are kept as an int with bit j set for vertex j
 class QIG(object):
     def __init__(self, db, cqs):
         self.db = db
         self.cqs = cqs        # cqid -> cqs
         self.vertices = {}    # cqid -> QIGVertex
+        self.cqids = []       # vertex index -> cqid
+        self.alive = 0        # bitset of vertices not removed
         self.posqigs = {}     # pos -> PosQIG
+        self.adj = None       # vertex index -> adjacency bitset, built on first use
+        self.truncated = False    # if the last clique search fell back to a greedy cover
+        self.clique_set = None    # maximal cliques kept up to date as CQs are removed
 
         self.init_vertices()
-        self.construct_pos_qigs()
-        self.combine_pos_qigs()
 
     def construct_pos_qigs(self):
         raise NotImplementedError
 
     def combine_pos_qigs(self):
-        first_posqig = self.posqigs[0]
-
-        explored = set()
-        for i, v1item in enumerate(self.vertices.items()):
-            v1id, v1 = v1item
-
-            for v2id in first_posqig.vertices[v1id].get_adjacent():
-                if v2id in explored:
-                    continue
-
-                v2 = self.vertices[v2id]
-
-                # only add an edge between two CQs if all PosQIGs have one
-                if all(g.has_edge(v1id, v2id) for g in self.posqigs.values()):
-                    self.add_edge(v1id, v2id)
-
-            explored.add(v1id)
+        self.adj = [0] * len(self.cqids)
+        for i in iter_bits(self.alive):
+            # only add an edge between two CQs if all PosQIGs have one
+            adj = self.alive & ~(1 << i)
+            for posqig in self.posqigs.values():
+                adj &= posqig.adjacent(i)
+                if not adj:
+                    break
+            self.adj[i] = adj
+
+    # adjacency bitsets, only built once something asks for edges
+    def adjacency(self):
+        if self.adj is None:
+            self.posqigs = {}
+            self.construct_pos_qigs()
+            self.combine_pos_qigs()
+        return self.adj
 
     def init_vertices(self):
         raise NotImplementedError
@@ -41,7 +49,13 @@ class QIG(object):
     def add_vertex(self, cqid, meta):
         if cqid in self.vertices:
             raise Exception('Vertex {} already exists!'.format(cqid))
-        self.vertices[cqid] = QIGVertex(cqid, meta)
+        index = len(self.cqids)
+        self.cqids.append(cqid)
+        self.vertices[cqid] = QIGVertex(self, cqid, index, meta)
+        self.alive |= 1 << index
+
+        # rebuilt with the new vertex when next needed
+        self.adj = None
 
     def get_vertex(self, cqid):
         if cqid not in self.vertices:
@@ -49,10 +63,19 @@ class QIG(object):
         return self.vertices[cqid]
 
     def remove_cq(self, cqid):
-        if cqid not in self.vertices:
-            raise Exception('Could not find vertex {}.'.format(cqid))
-        for adj in self.vertices[cqid].get_adjacent():
-            self.vertices[adj].remove_neighbor(cqid)
+        bit = 1 << self.get_vertex(cqid).index
+        self.remove_vertex(cqid)
+        if self.clique_set is not None:
+            self.clique_set.remove(bit)
+
+    def remove_vertex(self, cqid):
+        v = self.get_vertex(cqid)
+        bit = 1 << v.index
+        if self.adj is not None:
+            for j in iter_bits(self.adj[v.index]):
+                self.adj[j] &= ~bit
+            self.adj[v.index] = 0
+        self.alive &= ~bit
 
         self.vertices.pop(cqid, None)
         self.cqs.pop(cqid, None)
@@ -60,18 +83,38 @@ class QIG(object):
     def get_cqids(self):
         return self.vertices.keys()
 
-    def add_edge(self, cqid1, cqid2):
+    # bitset of the vertices of cqids
+    def mask(self, cqids):
+        mask = 0
+        for cqid in cqids:
+            mask |= 1 << self.get_vertex(cqid).index
+        return mask
+
+    def cqids_of(self, mask):
+        return set(self.cqids[i] for i in iter_bits(mask))
+
+    def get_adjacent(self, cqid):
+        return [self.cqids[j] for j in iter_bits(self.adjacency()[self.get_vertex(cqid).index])]
+
+    def has_edge(self, cqid1, cqid2):
+        if cqid1 not in self.vertices or cqid2 not in self.vertices:
+            return False
+        return bool(self.adjacency()[self.vertices[cqid1].index] >> self.vertices[cqid2].index & 1)
+
+    # edge metadata is a combination of posqig metas, computed on request
+    def get_edge(self, cqid1, cqid2):
+        if not self.has_edge(cqid1, cqid2):
+            raise Exception('{} has no edge to {}.'.format(cqid1, cqid2))
         v1 = self.get_vertex(cqid1)
         v2 = self.get_vertex(cqid2)
 
-        # meta is a combination of posqig metas
         meta = {}
-        for pos, posqig in self.posqigs.items():
-            meta[pos] = posqig.get_meta(cqid1, cqid2)
+        for pos in self.posqigs:
+            meta[pos] = self.edge_meta(pos, v1, v2)
+        return QIGEdge(meta)
 
-        e = QIGEdge(meta)
-        v1.add_neighbor(v2, e)
-        v2.add_neighbor(v1, e)
+    def edge_meta(self, pos, v1, v2):
+        raise NotImplementedError
 
     def get_meta(self, cqids):
         raise NotImplementedError
@@ -79,19 +122,7 @@ class QIG(object):
     def part_key(self, part):
         raise NotImplementedError
 
-    def bron_kerbosch(self, cliques, R, P, X):
-        if not P and not X:
-            cliques.append(R)
-            return cliques
-        for cqid in P:
-            singleton = set([cqid])
-            N = set(self.get_vertex(cqid).get_adjacent())
-            self.bron_kerbosch(cliques, R | singleton, P & N, X & N)
-            P = P - singleton
-            X = X | singleton
-        return cliques
-
-    def find_maximal_cliques(self):
+    def find_maximal_cliques(self, processes=None, time_budget=None, max_cliques=None):
         return NotImplementedError
 
     def find_partition_set(self):
@@ -117,69 +148,80 @@ class QIG(object):
 
     def update(self, cqs):
         diff = set(self.get_cqids()) - set(cqs.keys())
+        removed = self.mask(diff)
         for cqid in diff:
-            self.remove_cq(cqid)
+            self.remove_vertex(cqid)
 
+        # one pass over the cliques for all removed CQs
+        if self.clique_set is not None and removed:
+            self.clique_set.remove(removed)
+
+# adjacency lives in the QIG, vertices only point into it
 class QIGVertex(object):
-    def __init__(self, cqid, meta):
+    __slots__ = ('qig', 'cqid', 'index', 'meta')
+
+    def __init__(self, qig, cqid, index, meta):
+        self.qig = qig
         self.cqid = cqid
+        self.index = index
         self.meta = meta
-        self.adjacent = {}     # cqid -> QIGEdge
-
-    def add_neighbor(self, v, e):
-        self.adjacent[v.cqid] = e
-
-    def remove_neighbor(self, cqid):
-        self.adjacent.pop(cqid, None)
 
     def get_edge(self, cqid):
-        if cqid not in self.adjacent:
-            raise Exception('{} has no edge to {}.'.format(self.cqid, cqid))
-        return self.adjacent[cqid]
+        return self.qig.get_edge(self.cqid, cqid)
 
     def get_adjacent(self):
-        return self.adjacent.keys()
+        return self.qig.get_adjacent(self.cqid)
 
     def has_neighbor(self, cqid):
-        return cqid in self.adjacent
+        return self.qig.has_edge(self.cqid, cqid)
 
 class QIGEdge(object):
+    __slots__ = ('meta',)
+
     def __init__(self, meta):
         self.meta = meta     # dict with info about query intersections
 
-# Position-wise QIG
+# Position-wise QIG. vertices are grouped by their key at this position (a type
+# or an attribute) and edges are kept between keys, so all vertices with the
+# same key share one adjacency bitset
 class PosQIG(object):
     def __init__(self, db, pos):
         self.db = db
         self.pos = pos
-        self.vertices = {}     # cqid -> QIGVertex
-
-    def add_vertex(self, cqid, meta):
-        if cqid in self.vertices:
-            raise Exception('Vertex {} already exists!'.format(cqid))
-        self.vertices[cqid] = QIGVertex(cqid, meta)
-
-    def get_vertex(self, cqid):
-        if cqid not in self.vertices:
-            raise Exception('Could not find vertex {}.'.format(cqid))
-        return self.vertices[cqid]
-
-    def add_edge(self, cqid1, cqid2, meta):
-        v1 = self.get_vertex(cqid1)
-        v2 = self.get_vertex(cqid2)
-
-        e = QIGEdge(meta)
-        v1.add_neighbor(v2, e)
-        v2.add_neighbor(v1, e)
-
-    def has_edge(self, cqid1, cqid2):
-        return cqid1 in self.vertices \
-            and cqid2 in self.vertices \
-            and self.vertices[cqid1].has_neighbor(cqid2)
-
-    def get_meta(self, cqid1, cqid2):
-        v1 = self.get_vertex(cqid1)
-        return v1.get_edge(cqid2).meta
+        self.keys = {}         # vertex index -> key
+        self.members = {}      # key -> bitset of vertices with the key
+        self.key_edges = {}    # key -> keys adjacent to it
+        self.masks = {}        # key -> adjacency bitset, cached
+
+    def add_vertex(self, index, key):
+        if index in self.keys:
+            raise Exception('Vertex {} already exists!'.format(index))
+        self.keys[index] = key
+        self.members[key] = self.members.get(key, 0) | (1 << index)
+        self.masks = {}
+
+    def add_key_edge(self, key1, key2):
+        self.key_edges.setdefault(key1, set()).add(key2)
+        self.key_edges.setdefault(key2, set()).add(key1)
+        self.masks = {}
+
+    def get_keys(self):
+        return self.members.keys()
+
+    # bitset of the neighbors of vertex index, 0 if it has no key here
+    def adjacent(self, index):
+        if index not in self.keys:
+            return 0
+        key = self.keys[index]
+        if key not in self.masks:
+            mask = 0
+            for other in self.key_edges.get(key, ()):
+                mask |= self.members.get(other, 0)
+            self.masks[key] = mask
+        return self.masks[key] & ~(1 << index)
+
+    def has_edge(self, index1, index2):
+        return bool(self.adjacent(index1) >> index2 & 1)
 
 class QIGByType(QIG):
     def init_vertices(self):
@@ -203,23 +245,19 @@ class QIGByType(QIG):
             })
 
     def construct_pos_qigs(self):
-        for cqid, cq in self.cqs.items():
-            cq_types = self.get_vertex(cqid).meta['types']
-            for pos, type in enumerate(cq_types):
+        for cqid, v in self.vertices.items():
+            for pos, type in enumerate(v.meta['types']):
                 if pos not in self.posqigs:
                     self.posqigs[pos] = PosQIG(self.db, pos)
                 posqig = self.posqigs[pos]
 
-                posqig.add_vertex(cqid, { 'type': type })
-
-                for vid, v in posqig.vertices.items():
-                    # ignore if checking same vertex we just added
-                    if vid == cqid:
-                        continue
+                # edge only if type is the same
+                if type not in posqig.key_edges:
+                    posqig.add_key_edge(type, type)
+                posqig.add_vertex(v.index, type)
 
-                    # add edge only if type is the same
-                    if type == v.meta['type']:
-                        posqig.add_edge(cqid, vid, {})
+    def edge_meta(self, pos, v1, v2):
+        return {}
 
     def get_meta(self, cqids):
         if not cqids:
@@ -242,7 +280,7 @@ class QIGByType(QIG):
 
         return components.values()
 
-    def find_maximal_cliques(self):
+    def find_maximal_cliques(self, processes=None, time_budget=None, max_cliques=None):
         return self.find_type_components()
 
 class QIGByRange(QIGByType):
@@ -251,53 +289,90 @@ class QIGByRange(QIGByType):
         self.by_type_counter = {}
         super(QIGByRange, self).__init__(db, cqs)
 
+        # CQs projecting the same attributes have the same neighbors, so cliques
+        # are searched on a quotient graph with one vertex per signature
+        self.signatures = []      # signature index -> (attrs, types)
+        self.sig_members = []     # signature index -> bitset of its vertices
+        self.sig_of = {}          # vertex index -> signature index
+        self.sig_adj = []         # signature index -> bitset of adjacent signatures
+        self.sig_loops = 0        # bitset of signatures whose CQs are adjacent to each other
+        self.construct_quotient()
+
+    # whether CQs projecting attr1 and attr2 at a position may share values there
+    def attrs_adjacent(self, attr1, attr2):
+        if attr1 is None or attr2 is None:
+            return False
+        if attr1 == attr2:
+            return attr1.type == 'text' or attr1.type == 'num'
+        return self.aig.get_vertex(attr1).get_edge(attr2) is not None
+
+    def construct_quotient(self):
+        sig_index = {}
+        arity = 0
+        for cqid, v in self.vertices.items():
+            sig = (tuple(v.meta['attrs']), tuple(v.meta['types']))
+            if sig not in sig_index:
+                sig_index[sig] = len(self.signatures)
+                self.signatures.append(sig)
+                self.sig_members.append(0)
+            s = sig_index[sig]
+            self.sig_of[v.index] = s
+            self.sig_members[s] |= 1 << v.index
+            arity = max(arity, len(sig[0]))
+
+        self.sig_adj = [0] * len(self.signatures)
+        for s, (attrs1, _) in enumerate(self.signatures):
+            # CQs with fewer positions than the widest CQ get no edges
+            if len(attrs1) < arity:
+                continue
+            if all(self.attrs_adjacent(a, a) for a in attrs1):
+                self.sig_loops |= 1 << s
+            for t in range(s + 1, len(self.signatures)):
+                attrs2 = self.signatures[t][0]
+                if len(attrs2) == arity and all(self.attrs_adjacent(a1, a2) for a1, a2 in zip(attrs1, attrs2)):
+                    self.sig_adj[s] |= 1 << t
+                    self.sig_adj[t] |= 1 << s
+
+    def remove_vertex(self, cqid):
+        index = self.get_vertex(cqid).index
+        super(QIGByRange, self).remove_vertex(cqid)
+        self.sig_members[self.sig_of[index]] &= ~(1 << index)
+
+    # cliques of vertices from a clique K of signatures: all CQs of signatures
+    # adjacent to themselves and one CQ of each of the others
+    def expand_signatures(self, K):
+        base = 0
+        choices = []
+        for s in iter_bits(K):
+            if self.sig_loops >> s & 1:
+                base |= self.sig_members[s]
+            else:
+                choices.append([1 << i for i in iter_bits(self.sig_members[s])])
+        for picked in product(*choices):
+            yield base | sum(picked)
+
     def construct_pos_qigs(self):
-        attr_maps = {}      # pos -> attrs -> cqids
-        for cqid, cq in self.cqs.items():
-            cq_attrs = self.get_vertex(cqid).meta['attrs']
-            cq_types = self.get_vertex(cqid).meta['types']
-            for pos, attr in enumerate(cq_attrs):
+        for cqid, v in self.vertices.items():
+            for pos, attr in enumerate(v.meta['attrs']):
                 if pos not in self.posqigs:
                     self.posqigs[pos] = PosQIG(self.db, pos)
-                if pos not in attr_maps:
-                    attr_maps[pos] = {}
-                posqig = self.posqigs[pos]
-
-                posqig.add_vertex(cqid, {
-                    'attr': attr,
-                    'type': type
-                })
-
-                if attr not in attr_maps[pos]:
-                    attr_maps[pos][attr] = set()
-                attr_maps[pos][attr].add(cqid)
+                self.posqigs[pos].add_vertex(v.index, attr)
 
         for pos, posqig in self.posqigs.items():
-            for v1id, v1 in posqig.vertices.items():
-                v1attr = v1.meta['attr']
-
-                # same attribute case
-                for v2id in attr_maps[pos][v1attr]:
-                    if v1id == v2id:
-                        continue
-                    if v1attr.type == 'text':
-                        posqig.add_edge(v1id, v2id, {
-                            'intersect': AllAttributeIntersect('text')
-                        })
-                    elif v1attr.type == 'num':
-                        posqig.add_edge(v1id, v2id, {
-                            'intersect': AttributeIntersect('num', min=v1attr.min, max=v1attr.max)
-                        })
-
-                # intersecting attributes case
-                v1aig = self.aig.get_vertex(v1attr)
-                for v2attr in v1aig.get_adjacent():
-                    if v2attr in attr_maps[pos]:
-                        e = v1aig.get_edge(v2attr)
-                        for v2id in attr_maps[pos][v2attr]:
-                            posqig.add_edge(v1id, v2id, {
-                                'intersect': e.intersect
-                            })
+            attrs = posqig.get_keys()
+            for i, attr1 in enumerate(attrs):
+                for attr2 in attrs[i:]:
+                    if self.attrs_adjacent(attr1, attr2):
+                        posqig.add_key_edge(attr1, attr2)
+
+    def edge_meta(self, pos, v1, v2):
+        attr1 = v1.meta['attrs'][pos]
+        attr2 = v2.meta['attrs'][pos]
+        if attr1 == attr2:
+            if attr1.type == 'text':
+                return { 'intersect': AllAttributeIntersect('text') }
+            return { 'intersect': AttributeIntersect('num', min=attr1.min, max=attr1.max) }
+        return { 'intersect': self.aig.get_vertex(attr1).get_edge(attr2).intersect }
 
     def get_meta(self, cqids):
         if not cqids:
@@ -320,41 +395,26 @@ class QIGByRange(QIGByType):
         self.by_type_counter[types] += 1
         return key
 
-    def find_pivot(self, P, X):
-        max_size = 0
-        max_cqid = None
-        max_adj = None
-
-        for cqid in P | X:
-            adj = set(self.get_vertex(cqid).get_adjacent())
-            size = len(P & adj)
-
-            if size >= max_size:
-                max_size = size
-                max_cqid = cqid
-                max_adj = adj
-
-        return max_cqid, max_adj
-
-    def tomita(self, cliques, R, P, X):
-        if not P and not X:
-            cliques.append(R)
-            return cliques
-        u, u_adj = self.find_pivot(P, X)
-        for cqid in P - u_adj:
-            singleton = set([cqid])
-            N = set(self.get_vertex(cqid).get_adjacent())
-            self.tomita(cliques, R | singleton, P & N, X & N)
-            P = P - singleton
-            X = X | singleton
-        return cliques
-
-    def find_maximal_cliques(self):
-        results = []
-        components = self.find_type_components()
+    # cliques are enumerated once and then maintained by the clique set as CQs
+    # are removed
+    def find_maximal_cliques(self, processes=None, time_budget=None, max_cliques=None):
+        if self.clique_set is None:
+            cliques = self.enumerate_cliques(processes=processes, time_budget=time_budget, max_cliques=max_cliques)
+            self.clique_set = CliqueSet(cliques)
+        return [self.cqids_of(c) for c in self.clique_set.cliques]
+
+    # maximal cliques as vertex bitsets
+    def enumerate_cliques(self, processes=None, time_budget=None, max_cliques=None):
+        # type components of the signatures that still have CQs
+        components = {}
+        for s, members in enumerate(self.sig_members):
+            if members:
+                types = self.signatures[s][1]
+                components[types] = components.get(types, 0) | (1 << s)
 
-        for c in components:
-            cliques = self.tomita([], set(), c, set())
-            results.extend(cliques)
+        K, self.truncated = find_cliques(self.sig_adj, components.values(), processes=processes, time_budget=time_budget, max_cliques=max_cliques)
 
+        results = []
+        for k in K:
+            results.extend(self.expand_signatures(k))
         return results
@@ -1,16 +1,152 @@
+import hashlib
 import re
 
+from collections import deque
+
 from .database import AttributeIntersect
 from numbers import Number
 
+# max tuples checked per batched membership probe
+PROBE_BATCH_SIZE = 500
+# max CQs checked per single-tuple membership probe
+PROBE_UNION_SIZE = 100
+# marks where values go when compiling probe templates
+PROBE_PLACEHOLDER = u'\x00'
+
+# quoted string literals and identifiers, kept as is when normalizing whitespace
+QUOTED_RE = re.compile(r"""('(?:[^'\\]|\\.|'')*'|"(?:[^"\\]|\\.|"")*"|`(?:[^`]|``)*`)""", re.DOTALL)
+
+# collapses runs of whitespace outside quoted literals to single spaces
+def normalize_whitespace(sql):
+    parts = QUOTED_RE.split(sql)
+    for i in range(0, len(parts), 2):
+        parts[i] = re.sub(r'\s+', u' ', parts[i])
+    return u''.join(parts).strip()
+
+# max rows fetched at once when incrementally executing a timed out query
+INCREMENTAL_MAX_BATCH = 1024
+
+# streaming read of a timed out query being executed incrementally. rows come
+# from an unbuffered cursor held open on its own connection, and the tuples
+# already read are remembered so a reopened stream skips them
+class IncrementalCursor(object):
+    def __init__(self):
+        self.conn = None          # connection of the open stream
+        self.cursor = None
+        self.batch_size = 1       # rows to fetch next, doubles after each fetch
+        self.buffer = deque()     # fetched tuples not yet consumed
+        self.seen = set()         # tuples read so far, from this or earlier streams
+        self.exhausted = False    # all rows were read
+        self.timed_out = False    # a read ran past the timeout, until retry
+        self.error = None         # error that stopped the stream
+
+    # open streams are not carried over when pickled
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['conn'] = None
+        state['cursor'] = None
+        return state
+
+    def is_open(self):
+        return self.cursor is not None
+
+    def stopped(self):
+        return self.exhausted or self.timed_out or self.error is not None
+
+    # lets a stream that timed out be read again
+    def retry(self):
+        self.timed_out = False
+
+    def add(self, rows, codec):
+        if len(rows) < self.batch_size:
+            self.exhausted = True
+        self.batch_size = min(self.batch_size * 2, INCREMENTAL_MAX_BATCH)
+
+        for row in rows:
+            # disallow nulls
+            if None in row:
+                continue
+            t = codec.encode(row)
+            if t not in self.seen:
+                self.seen.add(t)
+                self.buffer.append(t)
+
+    # closes the connection without the cursor, which would first read the
+    # rest of the rows
+    def close(self):
+        if self.conn is not None:
+            try:
+                self.conn.close()
+            except Exception:
+                pass
+        self.cursor = None
+        self.conn = None
+
+    def consume(self):
+        if self.buffer:
+            self.buffer.popleft()
+
+    def discard(self, t):
+        self.seen.add(t)
+        if t in self.buffer:
+            self.buffer.remove(t)
+
+# membership probe for a query, compiled once with its projection metadata
+class ProbeTemplate(object):
+    def __init__(self, db, query):
+        self.attrs = [db.get_attr(proj) for proj in query.projs]
+        self.types = [attr.type for attr in self.attrs]
+
+        # static SQL around each projection value
+        self.parts = query.probe_str(db, [PROBE_PLACEHOLDER] * len(query.projs)).split(PROBE_PLACEHOLDER)
+
+        # for server-side prepared statement with bound values
+        self.prepared_str = self.fill([u'?'] * len(self.types)) + u' LIMIT 1'
+
+    def fill(self, vals):
+        sql = [self.parts[0]]
+        for i, val in enumerate(vals):
+            sql.append(val)
+            sql.append(self.parts[i + 1])
+        return u''.join(sql)
+
+    def types_match(self, t):
+        if len(t) != len(self.types):
+            return False
+
+        for i, attr_type in enumerate(self.types):
+            tuple_type = None
+            if isinstance(t[i], basestring):
+                tuple_type = 'text'
+            elif isinstance(t[i], Number):
+                tuple_type = 'num'
+
+            if tuple_type is not None and attr_type != tuple_type:
+                return False
+        return True
+
+    # False if some value of t cannot be stored in the projected attribute
+    def in_range(self, t):
+        for i, attr in enumerate(self.attrs):
+            if attr.type == 'num' and isinstance(t[i], Number) and attr.min is not None and attr.max is not None:
+                if t[i] < attr.min or t[i] > attr.max:
+                    return False
+            elif attr.type == 'text' and attr.length and isinstance(t[i], basestring):
+                if len(t[i].rstrip()) > attr.length:
+                    return False
+        return True
+
 class Query(object):
-    def __init__(self, cqid, query_str, projs, preds, w=1):
+    def __init__(self, cqid, query_str, projs, preds, w=1, fingerprint=None):
         self.cqid = cqid
         self.query_str = query_str
         self.projs = projs
         self.preds = preds
         self.w = w
 
+        # equal for semantically identical CQs, which share results and probes
+        self.fingerprint = fingerprint
+
         # cache tuples on self.tuples
         self.cached = False
         # self.cache_constraints = None
@@ -18,35 +154,73 @@ class Query(object):
 
         # set flag if timed out
         self.timed_out = False
-        # offset for selecting next tuple from timed out query
-        self.offset = 0
+        # set flag if timed out after reading some tuples into self.tuples
+        self.partial = False
+        # read position for selecting next tuples from timed out query
+        self.incremental = IncrementalCursor()
 
     def set_w(self, w):
         self.w = w
 
+    def get_fingerprint(self):
+        if getattr(self, 'fingerprint', None) is None:
+            # not canonicalized, only identical query text is shared
+            normalized = normalize_whitespace(self.query_str.strip().rstrip(u';'))
+            self.fingerprint = hashlib.sha1(normalized.encode('utf-8')).hexdigest()
+        return self.fingerprint
+
     def get_cost(self, db):
         if hasattr(self, 'cost'):
             return self.cost
-        else:
+
+        fingerprint = self.get_fingerprint()
+        if fingerprint not in db.costs:
             cursor = db.cursor()
             cursor.execute('EXPLAIN ' + self.query_str)
             cost = 1
             for row in cursor.fetchall():
                 if row[9]:
                     cost *= row[9]
-            self.cost = cost
-            return self.cost
+            db.costs[fingerprint] = cost
+        self.cost = db.costs[fingerprint]
+        return self.cost
 
     def empty_cache(self):
         self.cached = False
+        self.partial = False
         self.tuples = None
 
+    def get_incremental(self):
+        if not hasattr(self, 'incremental'):
+            self.incremental = IncrementalCursor()
+        return self.incremental
+
+    def get_probe(self, db):
+        if not hasattr(self, 'probe'):
+            self.probe = ProbeTemplate(db, self)
+        return self.probe
+
     @staticmethod
-    def tuple_in_query(db, t, query):
-        if len(t) != len(query.projs):
+    def sql_literal(val):
+        if isinstance(val, unicode) or isinstance(val, str):
+            return u"'{}'".format(val.replace('\\', '\\\\').replace("'", "''"))
+        else:
+            return u'{}'.format(val)
+
+    # checks locally whether the values t could belong to query before probing the database
+    @staticmethod
+    def may_contain(db, t, query):
+        probe = query.get_probe(db)
+        if not probe.types_match(t):
+            return False
+        if not probe.in_range(t):
+            db.probe_cache.skipped += 1
             return False
+        return True
 
-        query_str = query.query_str
+    # rewrites query to SELECT 1, constraining each projection to equal vals[i]
+    def probe_str(self, db, vals):
+        query_str = self.query_str
 
         if 'where' not in query_str.lower():
             query_str += u' WHERE '
@@ -57,23 +231,10 @@ class Query(object):
         # if multiple attrs for single rel, keeps the last one
         proj_alias_to_attr = {}
         preds = []
-        for i, proj in enumerate(query.projs):
-            if isinstance(t[i], unicode) or isinstance(t[i], str):
-                preds.append(u"{} = '{}'".format(proj, t[i].replace("'", "''")))
-            else:
-                preds.append(u"{} = {}".format(proj, t[i]))
+        for i, proj in enumerate(self.projs):
+            preds.append(u'{} = {}'.format(proj, vals[i]))
 
             attr = db.get_attr(proj)
-
-            tuple_type = None
-            if isinstance(t[i], basestring):
-                tuple_type = 'text'
-            elif isinstance(t[i], Number):
-                tuple_type = 'num'
-
-            if tuple_type is not None and attr.type != tuple_type:
-                return False
-
             if not attr.pk:
                 alias, attr_name = proj.split('.')
                 proj_alias_to_attr[alias] = attr_name
@@ -85,8 +246,26 @@ class Query(object):
             index_regex = 'AS ({})'.format(alias)
             query_str = re.sub(index_regex, 'AS \g<1> USE INDEX ({})'.format(attr_name), query_str)
 
-        query_str += ' LIMIT 1'
+        return query_str
+
+    # runs a single-tuple probe for the values t, returns None if it failed or timed out
+    @staticmethod
+    def run_probe(db, t, query):
+        probe = query.get_probe(db)
+
+        cursor = db.prepared_cursor(probe.prepared_str)
+        if cursor is not None:
+            try:
+                cursor.execute(probe.prepared_str, tuple(t))
+                return len(cursor.fetchall()) > 0
+            except Exception as e:
+                if str(e).startswith('3024'):
+                    return None
+                # don't retry a statement that fails to prepare or execute
+                db.discard_prepared(probe.prepared_str)
 
+        # if statement could not be prepared, fall back to plain SQL
+        query_str = probe.fill([Query.sql_literal(v) for v in t]) + u' LIMIT 1'
         try:
             cursor = db.cursor()
             cursor.execute(query_str)
@@ -94,9 +273,148 @@ class Query(object):
             cursor.close()
         except Exception as e:
             cursor.close()
-            if str(e).startswith('3024'):
-                return False
-            else:
+            if not str(e).startswith('3024'):
                 print(query_str.encode('utf-8'))
-                return False
+            return None
         return result
+
+    # t is an encoded tuple, as are the tuples passed to and returned by the
+    # other membership checks
+    @staticmethod
+    def tuple_in_query(db, t, query):
+        vals = db.codec.decode(t)
+        if not Query.may_contain(db, vals, query):
+            return False
+
+        cached = db.probe_cache.get(vals, query)
+        if cached is not None:
+            return cached
+
+        result = Query.run_probe(db, vals, query)
+        if result is None:
+            return False
+
+        db.probe_cache.put(vals, query, result)
+        return result
+
+    # returns the subset of ts that belong to query, checking PROBE_BATCH_SIZE
+    # tuples per round trip by joining them as a derived table
+    @staticmethod
+    def tuples_in_query(db, ts, query):
+        results = set()
+        unknown = []
+        values = {}
+        for t in ts:
+            values[t] = db.codec.decode(t)
+            if not Query.may_contain(db, values[t], query):
+                continue
+            cached = db.probe_cache.get(values[t], query)
+            if cached is None:
+                unknown.append(t)
+            elif cached:
+                results.add(t)
+
+        if not unknown:
+            return results
+
+        cols = ['probe.p{}'.format(i) for i in range(len(query.projs))]
+        exists_str = query.get_probe(db).fill(cols)
+
+        for start in range(0, len(unknown), PROBE_BATCH_SIZE):
+            batch = unknown[start:start + PROBE_BATCH_SIZE]
+
+            rows = []
+            for i, t in enumerate(batch):
+                vals = [Query.sql_literal(v) for v in values[t]]
+                if i == 0:
+                    vals = [u'{} AS p{}'.format(v, j) for j, v in enumerate(vals)]
+                    rows.append(u'SELECT {} AS i, {}'.format(i, ', '.join(vals)))
+                else:
+                    rows.append(u'SELECT {}, {}'.format(i, ', '.join(vals)))
+
+            query_str = u'SELECT probe.i FROM ({}) AS probe WHERE EXISTS ({})'.format(u' UNION ALL '.join(rows), exists_str)
+
+            cursor = db.cursor()
+            try:
+                cursor.execute(query_str)
+                found = set(batch[row[0]] for row in cursor.fetchall())
+                cursor.close()
+            except Exception as e:
+                cursor.close()
+                if not str(e).startswith('3024'):
+                    print(query_str.encode('utf-8'))
+                # fall back to checking each tuple individually
+                for t in batch:
+                    result = Query.run_probe(db, values[t], query)
+                    if result is not None:
+                        db.probe_cache.put(values[t], query, result)
+                    if result:
+                        results.add(t)
+                continue
+
+            for t in batch:
+                db.probe_cache.put(values[t], query, t in found)
+            results |= found
+        return results
+
+    # returns the cqids of the queries that contain t, checking PROBE_UNION_SIZE
+    # queries per round trip with a tagged UNION ALL of EXISTS subqueries
+    @staticmethod
+    def queries_containing_tuple(db, t, queries):
+        results = set()
+        unknown = []
+        # checked on the values of t from here on
+        t = db.codec.decode(t)
+        # fingerprint -> cqids of the equivalent queries, only one is probed
+        equivalent = {}
+        for query in queries:
+            fingerprint = query.get_fingerprint()
+            if fingerprint in equivalent:
+                equivalent[fingerprint].append(query.cqid)
+                continue
+            equivalent[fingerprint] = [query.cqid]
+
+            if not Query.may_contain(db, t, query):
+                continue
+            cached = db.probe_cache.get(t, query)
+            if cached is None:
+                unknown.append(query)
+            elif cached:
+                results.add(query.cqid)
+
+        vals = [Query.sql_literal(v) for v in t]
+
+        for start in range(0, len(unknown), PROBE_UNION_SIZE):
+            batch = unknown[start:start + PROBE_UNION_SIZE]
+
+            selects = []
+            for i, query in enumerate(batch):
+                selects.append(u'SELECT {} FROM DUAL WHERE EXISTS ({})'.format(i, query.get_probe(db).fill(vals)))
+            query_str = u' UNION ALL '.join(selects)
+
+            cursor = db.cursor()
+            try:
+                cursor.execute(query_str)
+                found = set(batch[row[0]].cqid for row in cursor.fetchall())
+                cursor.close()
+            except Exception as e:
+                cursor.close()
+                if not str(e).startswith('3024'):
+                    print(query_str.encode('utf-8'))
+                # fall back to checking each query individually
+                for query in batch:
+                    result = Query.run_probe(db, t, query)
+                    if result is not None:
+                        db.probe_cache.put(t, query, result)
+                    if result:
+                        results.add(query.cqid)
+                continue
+
+            for query in batch:
+                db.probe_cache.put(t, query, query.cqid in found)
+            results |= found
+
+        for cqids in equivalent.values():
+            if cqids[0] in results:
+                results.update(cqids)
+        return results
@@ -0,0 +1,224 @@
+from itertools import combinations
+import random
+
+import numpy as np
+
+from modules import algorithms
+from modules.algorithms import Base, EntropyIndex, GreedyBB, SignatureIndex, entropy_terms, skyline
+from modules.membership import MembershipMatrix
+
+class CQ(object):
+    def __init__(self, w):
+        self.w = w
+
+def random_state(seed, m=8, n=200):
+    rng = random.Random(seed)
+    Q = dict((cqid, CQ(rng.randint(1, 6))) for cqid in range(m))
+    tuples = {}
+    for t in range(n):
+        tuples[t] = set(cqid for cqid in Q if rng.random() < 0.4) or set([rng.randrange(m)])
+    return rng, Q, tuples
+
+def state_algorithm(Q, tuples):
+    algorithm = Base(None)
+    algorithm.sync_state(Q)
+    algorithm.tuples.update((t, set(S)) for t, S in tuples.items())
+    algorithm.refile(list(tuples))
+    return algorithm
+
+# signature -> tuples of the tuples that tell some CQs of Q apart
+def brute_force_signatures(Q, tuples):
+    sigs = {}
+    for t, S in tuples.items():
+        S = frozenset(S) & frozenset(Q)
+        if S and S != frozenset(Q):
+            sigs.setdefault(S, set()).add(t)
+    return sigs
+
+def objective(Q, S):
+    total_w = sum(cq.w for cq in Q.values())
+    return abs(2 * sum(Q[cqid].w for cqid in S) - total_w)
+
+def test_by_objective_order():
+    for seed in range(10):
+        rng, Q, tuples = random_state(seed)
+        index = SignatureIndex()
+        index.cq_weights = dict((cqid, cq.w) for cqid, cq in Q.items())
+        for t, S in tuples.items():
+            index.file(t, S)
+        # refile some tuples and drop others
+        for t in rng.sample(sorted(tuples), 50):
+            tuples[t] = set(rng.sample(sorted(Q), rng.randint(1, len(Q))))
+            index.file(t, tuples[t])
+        for t in rng.sample(sorted(tuples), 50):
+            del tuples[t]
+            index.remove(t)
+
+        total_w = sum(cq.w for cq in Q.values())
+        found = list(index.by_objective(total_w))
+        expected = set(frozenset(S) for S in tuples.values())
+        assert set(S for _, S in found) == expected
+        assert len(found) == len(expected)
+        assert [o for o, _ in found] == sorted(objective(Q, S) for S in expected)
+        assert all(o == objective(Q, S) for o, S in found)
+        for S in expected:
+            assert index.members[S] == set(t for t in tuples if frozenset(tuples[t]) == S)
+        assert sorted(index.sorted_weights) == index.sorted_weights
+        assert set(index.sorted_weights) == set(index.weights[S] for S in expected)
+
+def test_sync_state_drops_cqs_from_signatures():
+    for seed in range(10):
+        rng, Q, tuples = random_state(seed)
+        algorithm = state_algorithm(Q, tuples)
+        assert algorithm.signatures.members == brute_force_signatures(Q, tuples)
+
+        while len(Q) > 1:
+            Q = dict((cqid, cq) for cqid, cq in Q.items() if rng.random() < 0.7) or dict([Q.popitem()])
+            algorithm.sync_state(Q)
+
+            expected = brute_force_signatures(Q, tuples)
+            assert algorithm.signatures.members == expected
+            for S, ts in expected.items():
+                for t in ts:
+                    assert algorithm.tuples[t] == S
+            assert set(algorithm.tuples) == set(t for ts in expected.values() for t in ts)
+
+def test_min_objective_tuple_without_probes():
+    for seed in range(10):
+        rng, Q, tuples = random_state(seed)
+        algorithm = state_algorithm(Q, tuples)
+        sigs = brute_force_signatures(Q, tuples)
+
+        t, min_objective, _ = algorithm.min_objective_tuple(Q, [])
+        assert min_objective == min(objective(Q, S) for S in sigs)
+        assert objective(Q, tuples[t]) == min_objective
+
+        # only signatures with an even number of CQs
+        accept = lambda S: len(S) % 2 == 0
+        t, min_objective, _ = algorithm.min_objective_tuple(Q, [], accept=accept)
+        assert min_objective == min(objective(Q, S) for S in sigs if accept(S))
+        assert accept(tuples[t])
+
+def test_min_objective_tuple_nothing_accepted():
+    rng, Q, tuples = random_state(0)
+    algorithm = state_algorithm(Q, tuples)
+    assert algorithm.min_objective_tuple(Q, [], accept=lambda S: False)[:2] == (None, None)
+
+def brute_force_terms(index):
+    above = {}
+    below = {}
+    for a in index.members:
+        above[a] = sum(len(ts) for b, ts in index.members.items() if a < b)
+        below[a] = sum(1 for b in index.members if b < a)
+    return above, below
+
+def check_entropy_updates(seed):
+    rng, Q, tuples = random_state(seed, n=60)
+    index = EntropyIndex()
+    index.cq_weights = dict((cqid, cq.w) for cqid, cq in Q.items())
+    for t, S in tuples.items():
+        index.file(t, S)
+    index.update_entropies(Q)
+    assert (index.above, index.below) == brute_force_terms(index)
+
+    for step in range(30):
+        for t in rng.sample(sorted(tuples), rng.randint(1, 3)):
+            if rng.random() < 0.3:
+                index.remove(t)
+            else:
+                index.file(t, rng.sample(sorted(Q), rng.randint(1, len(Q))))
+        if rng.random() < 0.3:
+            S = rng.choice(list(index.members))
+            index.move(S, S - frozenset([rng.choice(sorted(S))]) or S)
+        index.update_entropies(Q)
+        assert (index.above, index.below) == brute_force_terms(index)
+        assert index.counts == dict((S, len(ts)) for S, ts in index.members.items())
+
+def test_entropy_updates_by_delta(monkeypatch):
+    monkeypatch.setattr(algorithms, 'ENTROPY_DELTA_MAX_PAIRS', 1 << 30)
+    for seed in range(5):
+        check_entropy_updates(seed)
+
+def test_entropy_updates_by_rebuild(monkeypatch):
+    monkeypatch.setattr(algorithms, 'ENTROPY_DELTA_MAX_PAIRS', 0)
+    for seed in range(5):
+        check_entropy_updates(seed)
+
+def random_signatures(seed, m, k):
+    rng = random.Random(seed)
+    Q = dict((cqid, CQ(1)) for cqid in range(m))
+    sigs = set()
+    while len(sigs) < k:
+        sigs.add(frozenset(rng.sample(range(m), rng.randint(1, m))))
+    matrix = MembershipMatrix(Q, dict((S, S) for S in sigs))
+    counts = np.array([rng.randint(1, 9) for _ in matrix.tuples], dtype=np.int64)
+    return matrix, counts
+
+def check_entropy_terms(matrix, counts):
+    above, below = entropy_terms(matrix, counts)
+    sigs = matrix.tuples
+    for i, a in enumerate(sigs):
+        assert above[i] == sum(c for b, c in zip(sigs, counts) if a < b)
+        assert below[i] == sum(1 for b in sigs if b < a)
+
+def test_entropy_terms_sum_over_subsets():
+    for seed in range(5):
+        matrix, counts = random_signatures(seed, 6, 30)
+        # few CQs for many signatures takes the sum over subsets
+        assert (1 << 6) <= len(matrix) ** 2
+        check_entropy_terms(matrix, counts)
+
+def test_entropy_terms_pairwise(monkeypatch):
+    for seed in range(5):
+        check_entropy_terms(*random_signatures(seed, 30, 40))
+
+    # a few signatures compared at once
+    monkeypatch.setattr(algorithms, 'ENTROPY_CHUNK_CELLS', 64)
+    for seed in range(5):
+        check_entropy_terms(*random_signatures(seed, 30, 40))
+
+def test_entropy_terms_branches_agree(monkeypatch):
+    matrix, counts = random_signatures(1, 8, 50)
+    sos = entropy_terms(matrix, counts)
+    monkeypatch.setattr(algorithms, 'ENTROPY_SOS_MAX_CQS', 0)
+    pairwise = entropy_terms(matrix, counts)
+    assert (sos[0] == pairwise[0]).all() and (sos[1] == pairwise[1]).all()
+
+# points no other point is at least as large as in both coordinates
+def brute_force_skyline(points):
+    points = set(points)
+    return sorted((p for p in points if not any(q != p and q[0] >= p[0] and q[1] >= p[1] for q in points)), reverse=True)
+
+def test_skyline_matches_brute_force():
+    rng = random.Random(0)
+    for _ in range(200):
+        points = [(rng.randint(0, 8), rng.randint(0, 8)) for _ in range(rng.randint(1, 30))]
+        result, m = skyline(points)
+        assert result == brute_force_skyline(points)
+        assert m == max(p[0] for p in points)
+
+def test_skyline_empty():
+    assert skyline([]) == ([], 0)
+
+# min over subsets S' of S of |w(S') - w(Q - S')|, by enumerating the subsets
+def brute_force_bound(Q, S):
+    S = [cqid for cqid in S if cqid in Q]
+    return min(objective(Q, sub) for r in range(len(S) + 1) for sub in combinations(S, r))
+
+def test_bound_matches_brute_force():
+    rng = random.Random(0)
+    algorithm = GreedyBB(None)
+    for _ in range(100):
+        Q = dict((cqid, CQ(rng.randint(1, 20))) for cqid in range(rng.randint(1, 10)))
+        S = rng.sample(sorted(Q), rng.randint(1, len(Q)))
+        assert algorithm.bound(Q, S) == brute_force_bound(Q, S)
+
+def test_bound_as_q_shrinks():
+    # memoized subset sums are reused for the same CQs and weights in a smaller Q
+    rng = random.Random(1)
+    algorithm = GreedyBB(None)
+    Q = dict((cqid, CQ(rng.randint(1, 20))) for cqid in range(10))
+    S = [0, 1, 2, 3]
+    while len(Q) > 1:
+        assert algorithm.bound(Q, S) == brute_force_bound(Q, S)
+        del Q[max(Q)]
@@ -0,0 +1,123 @@
+from itertools import combinations
+import random
+
+from modules import cliques as cliques_module
+from modules.cliques import CliqueSet, find_cliques, maximal_cliques
+from modules.membership import iter_bits
+
+def random_graph(n, p, seed):
+    rng = random.Random(seed)
+    adj = [0] * n
+    for i, j in combinations(range(n), 2):
+        if rng.random() < p:
+            adj[i] |= 1 << j
+            adj[j] |= 1 << i
+    return adj
+
+def is_clique(adj, mask):
+    return all(adj[i] & mask == mask & ~(1 << i) for i in iter_bits(mask))
+
+# maximal cliques by checking every vertex subset, for small graphs
+def brute_force_cliques(adj, vertices):
+    members = list(iter_bits(vertices))
+    cliques = []
+    for r in range(len(members), 0, -1):
+        for comb in combinations(members, r):
+            mask = sum(1 << i for i in comb)
+            if is_clique(adj, mask) and not any(c & mask == mask for c in cliques):
+                cliques.append(mask)
+    return set(cliques)
+
+def test_maximal_cliques_match_brute_force():
+    for seed in range(20):
+        adj = random_graph(10, 0.5, seed)
+        vertices = (1 << 10) - 1
+        found = list(maximal_cliques(adj, vertices))
+        assert len(found) == len(set(found))
+        assert set(found) == brute_force_cliques(adj, vertices)
+
+def test_maximal_cliques_of_induced_subgraph():
+    adj = random_graph(12, 0.6, 7)
+    vertices = 0b101101110110
+    assert set(maximal_cliques(adj, vertices)) == brute_force_cliques(adj, vertices)
+
+def test_maximal_cliques_isolated_vertices():
+    adj = [0, 0, 0]
+    assert set(maximal_cliques(adj, 0b111)) == set([0b001, 0b010, 0b100])
+
+def test_find_cliques_without_budget():
+    adj = random_graph(10, 0.5, 3)
+    components = [(1 << 10) - 1]
+    cliques, truncated = find_cliques(adj, components)
+    assert not truncated
+    assert set(cliques) == brute_force_cliques(adj, components[0])
+
+# past a budget the cliques found so far are kept and the uncovered vertices get
+# a greedy cover, so every vertex is still in some clique
+def check_truncated_cover(adj, components, cliques):
+    covered = 0
+    for c in cliques:
+        assert c
+        assert is_clique(adj, c)
+        covered |= c
+    for vertices in components:
+        assert covered & vertices == vertices
+
+def test_find_cliques_max_cliques():
+    adj = random_graph(30, 0.5, 11)
+    components = [(1 << 30) - 1]
+    all_cliques, _ = find_cliques(adj, components)
+
+    cliques, truncated = find_cliques(adj, components, max_cliques=5)
+    assert truncated
+    assert set(cliques[:5]) <= set(all_cliques)
+    check_truncated_cover(adj, components, cliques)
+
+def test_find_cliques_time_budget(monkeypatch):
+    # check the deadline on every step, so a spent budget stops the search at once
+    monkeypatch.setattr(cliques_module, 'DEADLINE_CHECK_STEPS', 1)
+    adj = random_graph(30, 0.5, 5)
+    components = [(1 << 30) - 1]
+    cliques, truncated = find_cliques(adj, components, time_budget=-1)
+    assert truncated
+    check_truncated_cover(adj, components, cliques)
+
+def test_find_cliques_budget_not_reached():
+    adj = random_graph(10, 0.5, 3)
+    components = [(1 << 10) - 1]
+    cliques, truncated = find_cliques(adj, components, time_budget=60, max_cliques=10000)
+    assert not truncated
+    assert set(cliques) == brute_force_cliques(adj, components[0])
+
+def test_find_cliques_by_component():
+    # two triangles and an edge between vertices 6 and 7
+    adj = [0b110, 0b101, 0b011, 0b110000, 0b101000, 0b011000, 1 << 7, 1 << 6]
+    components = [0b111, 0b111000, 0b11000000]
+    cliques, truncated = find_cliques(adj, components)
+    assert not truncated
+    assert sorted(cliques) == sorted(components)
+
+def test_clique_set_remove_matches_recomputing():
+    rng = random.Random(1)
+    for seed in range(20):
+        adj = random_graph(11, 0.5, seed)
+        vertices = (1 << 11) - 1
+        clique_set = CliqueSet(maximal_cliques(adj, vertices))
+        while vertices:
+            removed = 0
+            for i in rng.sample(list(iter_bits(vertices)), min(2, bin(vertices).count('1'))):
+                removed |= 1 << i
+            vertices &= ~removed
+            clique_set.remove(removed)
+            assert len(clique_set) == len(set(clique_set.cliques))
+            assert set(clique_set.cliques) == brute_force_cliques(adj, vertices)
+
+def test_clique_set_remove_keeps_untouched_cliques():
+    # triangle 0-1-2 and edge 2-3, removing 3 leaves the triangle
+    clique_set = CliqueSet([0b0111, 0b1100])
+    clique_set.remove(0b1000)
+    assert clique_set.cliques == [0b0111]
+
+    clique_set.remove(0b0100)
+    assert clique_set.cliques == [0b0011]
+    assert len(clique_set) == 1
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+from modules.database import AttributeIntersect, TupleCodec
+
+def test_codec_round_trip():
+    codec = TupleCodec()
+    tuples = [(1, u'a', None), (2, u'b', 3.5), (1, u'b', None), (0,), (u'été', 0, 0, 0), ()]
+    keys = [codec.encode(t) for t in tuples]
+    assert len(set(keys)) == len(tuples)
+    assert [codec.decode(key) for key in keys] == tuples
+
+def test_codec_same_tuple_same_key():
+    codec = TupleCodec()
+    key = codec.encode((5, u'x'))
+    codec.encode((6, u'y'))
+    assert codec.encode((5, u'x')) == key
+    assert len(codec) == 4
+
+def test_codec_trailing_zero_ids():
+    # first values get id 0 at every position, the sentinel keeps the length
+    codec = TupleCodec()
+    assert codec.decode(codec.encode((u'a', u'b', u'c'))) == (u'a', u'b', u'c')
+    assert codec.decode(codec.encode((u'a',))) == (u'a',)
+
+def test_codec_encode_all():
+    codec = TupleCodec()
+    tuples = set([(1, 2), (2, 1), (1, 1)])
+    keys = codec.encode_all(tuples)
+    assert len(keys) == 3
+    assert codec.decode_all(keys) == tuples
+
+def test_text_intersect_rules_out_ascii_only():
+    intersect = AttributeIntersect('text', vals=[u'Strasse', u'abc '])
+    assert intersect.contains(u'STRASSE')
+    assert intersect.contains(u'abc')
+    assert not intersect.contains(u'xyz')
+    # collations may match these to the values, so they are left to the database
+    assert intersect.contains(u'Stra\xdfe')
+    assert intersect.contains(u'xyz\x01')
+
+def test_text_intersect_with_non_ascii_values():
+    intersect = AttributeIntersect('text', vals=[u'Stra\xdfe', u'abc'])
+    assert intersect.contains(u'strasse')
+    assert intersect.contains(u'zzz')
@@ -0,0 +1,56 @@
+import random
+
+import numpy as np
+
+from modules import membership
+from modules.membership import CQBitmask, MembershipMatrix, iter_bits
+
+class CQ(object):
+    def __init__(self, w):
+        self.w = w
+
+def random_membership(seed, m, n):
+    rng = random.Random(seed)
+    Q = dict((cqid, CQ(rng.randint(1, 5))) for cqid in rng.sample(range(100), m))
+    cqids = sorted(Q)
+    # few distinct CQ sets, so tuples share them
+    sets = [set(c for c in cqids if rng.random() < 0.5) for _ in range(10)]
+    T = dict((t, rng.choice(sets)) for t in range(n))
+    return Q, T
+
+def check_matrix(Q, T):
+    matrix = MembershipMatrix(Q, T)
+    assert len(matrix) == len(T)
+    assert matrix.cqids == sorted(Q)
+
+    dense = np.unpackbits(matrix.bits, axis=1)[:, :len(Q)]
+    for row, t in enumerate(matrix.tuples):
+        assert set(matrix.cqids[i] for i in np.flatnonzero(dense[row])) == T[t]
+
+    unique, inverse = matrix.signatures()
+    assert len(unique) == len(set(frozenset(S) for S in T.values()))
+    assert (unique[inverse] == matrix.bits).all()
+
+    bits = CQBitmask(Q)
+    assert matrix.masks().tolist() == [bits.mask(T[t]) for t in matrix.tuples]
+
+def test_membership_matrix_matches_sets():
+    for seed in range(5):
+        check_matrix(*random_membership(seed, 13, 300))
+
+def test_membership_matrix_in_chunks(monkeypatch):
+    # a few rows per dense block
+    monkeypatch.setattr(membership, 'MEMBERSHIP_CHUNK_CELLS', 40)
+    for seed in range(5):
+        check_matrix(*random_membership(seed, 13, 300))
+
+def test_membership_matrix_empty():
+    Q, T = random_membership(0, 5, 0)
+    matrix = MembershipMatrix(Q, T)
+    assert len(matrix) == 0
+    assert matrix.masks().tolist() == []
+
+def test_iter_bits():
+    assert list(iter_bits(0)) == []
+    assert list(iter_bits(0b1011001)) == [0, 3, 4, 6]
+    assert list(iter_bits(1 << 100)) == [100]
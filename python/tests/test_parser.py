@@ -0,0 +1,57 @@
+from moz_sql_parser import parse
+
+from modules.parser import fingerprint
+
+def fp(sql):
+    return fingerprint(parse(sql))
+
+def test_fingerprint_alias_names():
+    assert fp('SELECT a.name FROM actor a WHERE a.id = 1') == \
+        fp('SELECT x.name FROM actor x WHERE x.id = 1')
+
+def test_fingerprint_join_and_predicate_order():
+    a = fp('SELECT m.title FROM movie m, cast_info c WHERE m.id = c.movie_id AND c.role = 2')
+    b = fp('SELECT m.title FROM cast_info c, movie m WHERE c.role = 2 AND c.movie_id = m.id')
+    assert a is not None
+    assert a == b
+
+def test_fingerprint_mirrored_comparison():
+    assert fp('SELECT m.title FROM movie m WHERE m.year > 2000') == \
+        fp('SELECT m.title FROM movie m WHERE 2000 < m.year')
+
+def test_fingerprint_inner_join_on():
+    assert fp('SELECT movie.title FROM movie JOIN cast_info ON movie.id = cast_info.movie_id WHERE cast_info.role = 2') == \
+        fp('SELECT movie.title FROM movie, cast_info WHERE movie.id = cast_info.movie_id AND cast_info.role = 2')
+
+def test_fingerprint_self_join_aliases():
+    # the two copies of movie can only be told apart by their predicates
+    a = fp('SELECT m1.title FROM movie m1, movie m2 WHERE m1.year = m2.year AND m2.id = 3')
+    b = fp('SELECT m2.title FROM movie m1, movie m2 WHERE m2.year = m1.year AND m1.id = 3')
+    assert a == b
+
+def test_fingerprint_different_constants():
+    assert fp("SELECT a.name FROM actor a WHERE a.name = 'Kim'") != \
+        fp("SELECT a.name FROM actor a WHERE a.name = 'Lee'")
+
+def test_fingerprint_different_columns():
+    assert fp('SELECT a.name FROM actor a WHERE a.id = 1') != \
+        fp('SELECT a.name FROM actor a WHERE a.age = 1')
+
+def test_fingerprint_different_projection():
+    assert fp('SELECT m.title FROM movie m WHERE m.id = 1') != \
+        fp('SELECT m.year FROM movie m WHERE m.id = 1')
+
+def test_fingerprint_different_self_join_projection():
+    # projecting the copy of movie with the constant is not the same query
+    a = fp('SELECT m1.title FROM movie m1, movie m2 WHERE m1.year = m2.year AND m2.id = 3')
+    b = fp('SELECT m1.title FROM movie m1, movie m2 WHERE m1.year = m2.year AND m1.id = 3')
+    assert a != b
+
+def test_fingerprint_unhandled_clauses():
+    # parse tree of SELECT m.title FROM movie m LEFT JOIN cast_info c ON m.id = c.movie_id
+    parsed = {
+        'select': {'value': 'm.title'},
+        'from': [{'value': 'movie', 'name': 'm'}, {'left join': {'value': 'cast_info', 'name': 'c'}, 'on': {'eq': ['m.id', 'c.movie_id']}}]
+    }
+    assert fingerprint(parsed) is None
+    assert fingerprint({'select': {'value': 'a'}}) is None
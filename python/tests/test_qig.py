@@ -0,0 +1,82 @@
+from itertools import combinations
+import random
+
+from modules.qig import QIGByRange
+
+from test_cliques import brute_force_cliques
+
+# stand-ins for the schema: attributes are plain objects, the AIG only answers
+# whether two attributes intersect
+class Attr(object):
+    def __init__(self, name, type):
+        self.name = name
+        self.type = type
+
+    def __repr__(self):
+        return self.name
+
+class Edge(object):
+    intersect = None
+
+class AIGVertex(object):
+    def __init__(self, aig, attr):
+        self.aig = aig
+        self.attr = attr
+
+    def get_edge(self, other):
+        if frozenset([self.attr, other]) in self.aig.edges:
+            return Edge()
+        return None
+
+class AIG(object):
+    def __init__(self, edges):
+        self.edges = edges
+
+    def get_vertex(self, attr):
+        return AIGVertex(self, attr)
+
+class DB(object):
+    def get_attr(self, proj):
+        return proj
+
+class CQ(object):
+    def __init__(self, projs):
+        self.projs = projs
+
+def random_qig(seed):
+    rng = random.Random(seed)
+    attrs = {
+        'text': [Attr('t{}'.format(i), 'text') for i in range(3)],
+        'num': [Attr('n{}'.format(i), 'num') for i in range(2)],
+        'date': [Attr('d{}'.format(i), 'date') for i in range(2)]
+    }
+    edges = set()
+    for same in attrs.values():
+        for a1, a2 in combinations(same, 2):
+            if rng.random() < 0.7:
+                edges.add(frozenset([a1, a2]))
+
+    # a few type patterns so type components have several signatures, dates
+    # are not adjacent to themselves and num attributes are
+    patterns = [('text', 'date'), ('text', 'num'), ('date',)]
+    cqs = {}
+    for cqid in range(14):
+        types = patterns[0] if rng.random() < 0.6 else rng.choice(patterns[1:])
+        cqs[cqid] = CQ([rng.choice(attrs[t]) for t in types])
+    return QIGByRange(DB(), cqs, AIG(edges))
+
+# cliques from the quotient graph, expanded back to CQs, are the maximal cliques
+# of the graph over all CQs
+def test_quotient_expansion_matches_brute_force():
+    for seed in range(20):
+        qig = random_qig(seed)
+        adj = qig.adjacency()
+        found = qig.enumerate_cliques()
+        assert len(found) == len(set(found))
+        assert set(found) == brute_force_cliques(adj, qig.alive)
+
+def test_quotient_expansion_after_removal():
+    qig = random_qig(5)
+    for cqid in [0, 3, 7]:
+        qig.remove_cq(cqid)
+    assert set(qig.enumerate_cliques()) == brute_force_cliques(qig.adjacency(), qig.alive)
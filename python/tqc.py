@@ -76,16 +76,17 @@ def cq_tq_intersect_props(db, cqid, tqid, cq, tq, tq_count, tq_types):
         if str(e).startswith('3024'):
             cursor.close()
 
-            # if it times out, sample 1000-10000 tuples from the target query and check them individually
+            # if it times out, sample 1000-10000 tuples from the target query and check them in batches
             print('Intersect calculation timed out for {}; sampling...'.format(cqid))
-            intersects = 0
             cursor = db.cursor()
             try:
                 cursor.execute('SELECT /*+ MAX_EXECUTION_TIME(100000) */ * FROM tq LIMIT {}'.format(SAMPLE_COUNT))
-                for t in cursor.fetchall():
-                    if Query.tuple_in_query(db, t, cq):
-                        intersects += 1
+                sample = [db.codec.encode(row) for row in cursor.fetchall()]
                 cursor.close()
+
+                # count sample rows, not distinct tuples, so duplicate rows weigh in
+                found = Query.tuples_in_query(db, set(sample), cq)
+                intersects = sum(1 for t in sample if t in found)
                 return intersects / SAMPLE_COUNT
             except Exception:
                 cursor.close()